@@ -0,0 +1,780 @@
+# Benchmarks which run against a synthetic tablet, no device needed
+#
+#   python -m remarkable_mouse.bench ring
+#   python -m remarkable_mouse.bench predict [recording]
+#   python -m remarkable_mouse.bench alloc
+#   python -m remarkable_mouse.bench soak [recording]
+#   python -m remarkable_mouse.bench stages
+
+import argparse
+import asyncio
+import bisect
+import functools
+import gc
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import statistics
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from screeninfo import Monitor
+
+from .common import Mapping, Watchdog, reMarkable2
+from .core import Tablet, decode, read_stream
+from .filters import JitterFilter, Predictor, Recorder, load_recording
+from .frames import (
+    ABS_PRESSURE, ABS_X, ABS_Y, BTN_TOOL_PEN, BTN_TOUCH, EV_ABS, EV_KEY,
+    EV_SYN, SYN_REPORT, TOOL_PEN, TOUCH, FrameAssembler, FrameBatch, HoverPolicy,
+    PenFrame, abs_fields, batched, button_bits
+)
+from .ring import RingTablet
+from .rules import EventRules
+from .state import StateWriter
+from .stats import Histogram, Stats, quantile
+from .transport import TCPStream
+
+
+def synthetic_frame(rm, t):
+    """Events for one frame of a pen tracing a circle
+
+    Args:
+        rm (reMarkable): tablet settings
+        t (float): wall clock time, used for the event timestamps and position
+
+    Returns:
+        bytes: packed evdev events ending with SYN_REPORT
+    """
+    event = struct.Struct(rm.e_format)
+    sec, usec = int(t), int(t % 1 * 1e6)
+    x = int(rm.pen_x.max * (0.5 + 0.3 * math.cos(t)))
+    y = int(rm.pen_y.max * (0.5 + 0.3 * math.sin(t)))
+    pressure = int(rm.pen_pressure.max * (0.5 + 0.4 * math.sin(7 * t)))
+    return b''.join((
+        event.pack(sec, usec, EV_ABS, ABS_X, x),
+        event.pack(sec, usec, EV_ABS, ABS_Y, y),
+        event.pack(sec, usec, EV_ABS, ABS_PRESSURE, pressure),
+        event.pack(sec, usec, EV_SYN, SYN_REPORT, 0),
+    ))
+
+
+def serve_synthetic(conn, rate, seconds):
+    """Stream synthetic pen frames at `rate` Hz to the first client
+
+    The listening port is sent over `conn`.  Runs in its own process so the
+    load in the process under test doesn't skew the timestamps.
+    """
+    rm = reMarkable2()
+    event = struct.Struct(rm.e_format)
+    server = socket.create_server(('127.0.0.1', 0))
+    conn.send(server.getsockname()[1])
+    client, _ = server.accept()
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    t = time.time()
+    client.sendall(b''.join((
+        event.pack(int(t), 0, EV_KEY, BTN_TOOL_PEN, 1),
+        event.pack(int(t), 0, EV_KEY, BTN_TOUCH, 1),
+    )))
+    start = time.monotonic()
+    n = 0
+    while time.monotonic() - start < seconds:
+        n += 1
+        delay = start + n / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            client.sendall(synthetic_frame(rm, time.time()))
+        except BrokenPipeError:
+            break
+    client.close()
+    server.close()
+
+
+class SyntheticTablet(reMarkable2):
+    """reMarkable 2 whose pen stream comes from serve_synthetic
+
+    Args:
+        port (int): local port of the synthetic server
+    """
+
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+
+    @property
+    def pen(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        return TCPStream(sock)
+
+
+class LatencySink:
+    """Record the delay between each frame's timestamp and its delivery"""
+
+    def __init__(self):
+        self.latencies = []
+
+    def send(self, frame):
+        self.latencies.append(time.time() - frame.time)
+
+
+def cpu_load(stop):
+    """Keep the GIL busy with pure Python work until `stop` is set"""
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def run_synthetic(tablet_cls, sink, *, rate, seconds, load=0):
+    """Run a synthetic session through `tablet_cls` into `sink`
+
+    Args:
+        tablet_cls (type): Tablet or RingTablet
+        sink: output backend
+        rate (float): frames per second
+        seconds (float): session length
+        load (int): number of CPU-bound threads in this process
+
+    Returns:
+        Stats: counters of the session
+    """
+    conn, child_conn = multiprocessing.Pipe(duplex=False)
+    producer = multiprocessing.Process(
+        target=serve_synthetic, args=(child_conn, rate, seconds)
+    )
+    producer.start()
+    port = conn.recv()
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=cpu_load, args=(stop,), daemon=True)
+        for _ in range(load)
+    ]
+    for thread in threads:
+        thread.start()
+
+    stats = Stats()
+    tablet = tablet_cls(
+        functools.partial(SyntheticTablet, port),
+        lambda rm: sink,
+        stats=stats,
+        stall_timeout=0,
+    )
+    try:
+        asyncio.run(tablet.run())
+    finally:
+        stop.set()
+        producer.join()
+    return stats
+
+
+def print_latencies(name, latencies):
+    ms = [l * 1000 for l in latencies]
+    quantiles = statistics.quantiles(ms, n=100)
+    print('{: <16} {: >7} {: >8.2f} {: >8.2f} {: >8.2f} {: >8.2f}'.format(
+        name, len(ms), quantiles[49], quantiles[98], max(ms), statistics.stdev(ms)
+    ))
+
+
+def bench_ring(args):
+    """Compare delivery jitter of the single process and reader process paths"""
+    print(f"{args.rate:.0f} Hz for {args.seconds}s with {args.load} load threads")
+    print('{: <16} {: >7} {: >8} {: >8} {: >8} {: >8}'.format(
+        'path', 'frames', 'p50 ms', 'p99 ms', 'max ms', 'jitter'
+    ))
+    for name, tablet_cls in (('single process', Tablet), ('reader process', RingTablet)):
+        sink = LatencySink()
+        run_synthetic(
+            tablet_cls, sink, rate=args.rate, seconds=args.seconds, load=args.load
+        )
+        print_latencies(name, sink.latencies)
+
+
+def synthetic_recording(seconds=30, rate=500):
+    """Frames of a pen drawing loops with pauses, in place of a recording"""
+    rm = reMarkable2()
+    frames = []
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        frame = PenFrame()
+        frame.time = t
+        frame.x = int(rm.pen_x.max * (0.5 + 0.3 * math.cos(t) + 0.05 * math.cos(9 * t)))
+        frame.y = int(rm.pen_y.max * (0.5 + 0.3 * math.sin(t) + 0.05 * math.sin(5 * t)))
+        frame.buttons = TOOL_PEN | (TOUCH if math.sin(1.3 * t) > -0.3 else 0)
+        frames.append(frame)
+    return frames
+
+
+def prediction_errors(frames, predict, lead):
+    """Distance between predicted and recorded positions during strokes
+
+    Args:
+        frames (list): recorded frames, the ground truth
+        predict (function): takes each frame in order and returns the
+            predicted (x, y)
+        lead (float): seconds ahead the prediction is for
+
+    Returns:
+        list of float: error in tablet units for each frame in contact
+    """
+    times = [frame.time for frame in frames]
+    errors = []
+    for frame in frames:
+        x, y = predict(frame)
+        # where the pen really was `lead` later
+        t = frame.time + lead
+        i = bisect.bisect_left(times, t)
+        if i == len(frames):
+            break
+        a, b = frames[max(i - 1, 0)], frames[i]
+        if not frame.buttons & a.buttons & b.buttons & TOUCH:
+            continue
+        w = (t - a.time) / (b.time - a.time) if b.time > a.time else 0
+        errors.append(math.hypot(
+            x - (a.x + w * (b.x - a.x)),
+            y - (a.y + w * (b.y - a.y)),
+        ))
+    return errors
+
+
+def bench_predict(args):
+    """Replay a recording through each prediction model"""
+    if args.recording:
+        frames = load_recording(args.recording)
+    else:
+        print("No recording given, using a synthetic one")
+        frames = synthetic_recording()
+    lead = args.lead / 1000
+    print(f"{len(frames)} frames, predicting {args.lead:.0f} ms ahead")
+    print('{: <16} {: >8} {: >8} {: >8}'.format('model', 'mean', 'p95', 'max'))
+    for model in ('none', 'velocity', 'acceleration'):
+        if model == 'none':
+            # the cursor as it trails the pen today
+            predict = lambda frame: (frame.x, frame.y)
+        else:
+            predict = Predictor(
+                NullSink(), lead=lead, model=model, smoothing=args.smoothing
+            ).predict
+        errors = prediction_errors(frames, predict, lead)
+        print('{: <16} {: >8.1f} {: >8.1f} {: >8.1f}'.format(
+            model, statistics.mean(errors),
+            statistics.quantiles(errors, n=20)[18], max(errors)
+        ))
+    print("errors in tablet units")
+
+
+class AllocationSink:
+    """Measure memory growth and garbage collections between two frames
+
+    Args:
+        rm (reMarkable): tablet settings
+        start (int): frame at which to start measuring, after warming up
+        stop (int): frame at which to stop measuring
+    """
+
+    def __init__(self, rm, start, stop):
+        self.mapping = Mapping(rm, Monitor(0, 0, 1920, 1080), 'fill', 'right')
+        self.start = start
+        self.stop = stop
+        self.frames = 0
+        self.collections = 0
+        self.memory = None
+        self.snapshot = None
+
+    def count(self, phase, info):
+        if phase == 'start':
+            self.collections += 1
+
+    def send(self, frame):
+        self.mapping(frame.x, frame.y)
+        self.frames += 1
+        if self.frames == self.start:
+            gc.callbacks.append(self.count)
+            self.memory = tracemalloc.get_traced_memory()[0]
+            self.snapshot = tracemalloc.take_snapshot()
+        elif self.frames == self.stop:
+            gc.callbacks.remove(self.count)
+            self.memory = tracemalloc.get_traced_memory()[0] - self.memory
+            self.snapshot = tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')
+
+
+def bench_alloc(args):
+    """Check that the steady state read loop allocates nothing that survives a frame"""
+    rm = reMarkable2()
+    frames = args.frames
+    event = struct.Struct(rm.e_format)
+    data = b''.join((
+        event.pack(0, 0, EV_KEY, BTN_TOOL_PEN, 1),
+        event.pack(0, 0, EV_KEY, BTN_TOUCH, 1),
+        *(synthetic_frame(rm, i / 500) for i in range(frames)),
+    ))
+
+    reader, writer = socket.socketpair()
+    reader.setblocking(False)
+
+    def feed():
+        writer.sendall(data)
+        writer.close()
+
+    sink = AllocationSink(rm, frames // 4, frames * 3 // 4)
+    stats = Stats()
+    pipeline = Predictor(JitterFilter(sink, stats=stats), lead=0.02)
+    tracemalloc.start()
+    threading.Thread(target=feed, daemon=True).start()
+    try:
+        asyncio.run(read_stream(
+            reader, rm, FrameAssembler(HoverPolicy(stats=stats)), pipeline,
+            stats=stats, watchdog=Watchdog(0, stats),
+        ))
+    except EOFError:
+        pass
+    finally:
+        tracemalloc.stop()
+        reader.close()
+
+    measured = sink.stop - sink.start
+    per_frame = sink.memory / measured
+    print(f"{measured} frames measured after {sink.start} frames of warm up")
+    print(f"memory growth: {sink.memory} bytes ({per_frame:.3f} bytes/frame)")
+    print(f"garbage collections: {sink.collections}")
+    if per_frame > args.limit:
+        for stat in sink.snapshot[:5]:
+            print(stat)
+        raise SystemExit(f"more than {args.limit} bytes/frame retained")
+
+
+def frame_events(rm, frames):
+    """Encode frames, e.g. from a recording, as the evdev stream producing them
+
+    Returns:
+        bytes: packed events, each frame ending with SYN_REPORT
+    """
+    event = struct.Struct(rm.e_format)
+    buttons = 0
+    chunks = []
+    for frame in frames:
+        sec, usec = int(frame.time), int(frame.time % 1 * 1e6)
+        for e_code, bit in button_bits.items():
+            if (frame.buttons ^ buttons) & bit:
+                chunks.append(event.pack(sec, usec, EV_KEY, e_code, int(bool(frame.buttons & bit))))
+        buttons = frame.buttons
+        for e_code, name in abs_fields.items():
+            chunks.append(event.pack(sec, usec, EV_ABS, e_code, getattr(frame, name)))
+        chunks.append(event.pack(sec, usec, EV_SYN, SYN_REPORT, 0))
+    return b''.join(chunks)
+
+
+class SoakSource:
+    """Serve the same segment of pen traffic on each new connection
+
+    Every connection but the last stalls after its segment, so the
+    watchdog has to give up on it and the tablet reconnects, going through
+    the same teardown as a real dropped connection.
+
+    Args:
+        data (bytes): events of one segment
+        segments (int): number of connections to serve
+    """
+
+    def __init__(self, data, segments):
+        self.data = data
+        self.remaining = segments
+
+    def open(self):
+        """Socket streaming the next segment"""
+        self.remaining -= 1
+        reader, writer = socket.socketpair()
+        threading.Thread(
+            target=self.feed, args=(writer, self.remaining <= 0), daemon=True
+        ).start()
+        return reader
+
+    def feed(self, writer, last):
+        try:
+            writer.sendall(self.data)
+            if not last:
+                # returns once the reader closes its end
+                writer.recv(1)
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+
+class SoakTablet(reMarkable2):
+    """reMarkable 2 whose pen stream comes from a SoakSource"""
+
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+
+    @property
+    def pen(self):
+        return TCPStream(self.source.open())
+
+
+def current_rss():
+    """Resident set size in bytes, None where /proc isn't available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def open_fds():
+    """Number of open file descriptors, None where /proc isn't available"""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+class SoakSink:
+    """Fake output backend sampling resource use every `every` frames
+
+    Args:
+        rm (reMarkable): tablet settings
+        stats (Stats): counters of the session, with stage latencies
+        every (int): frames between samples
+        frame_seconds (float): pen time each frame stands for
+    """
+
+    def __init__(self, rm, stats, every, frame_seconds):
+        self.mapping = Mapping(rm, Monitor(0, 0, 1920, 1080), 'fill', 'right')
+        self.stats = stats
+        self.every = every
+        self.frame_seconds = frame_seconds
+        self.frames = 0
+        self.counts = {}
+        self.samples = []
+        self.snapshot = None
+
+    def send(self, frame):
+        self.mapping(frame.x, frame.y)
+        self.frames += 1
+        if self.frames % self.every == 0:
+            self.sample()
+
+    def sample(self):
+        # stage latencies since the previous sample
+        windows = {}
+        for stage, histogram in self.stats.latency.items():
+            previous = self.counts.get(stage, [0] * len(histogram.counts))
+            windows[stage] = [a - b for a, b in zip(histogram.counts, previous)]
+            self.counts[stage] = list(histogram.counts)
+        collections = [gen['collections'] for gen in gc.get_stats()]
+        # only count memory which is still reachable, and leave out the
+        # samples kept by this benchmark
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, __file__)]
+        )
+        self.samples.append(dict(
+            hours=self.frames * self.frame_seconds / 3600,
+            rss=current_rss(),
+            traced=sum(trace.size for trace in snapshot.traces),
+            fds=open_fds(),
+            collections=collections,
+            latency=windows,
+        ))
+        if self.snapshot is None:
+            self.snapshot = snapshot
+
+
+def merge_windows(samples, stage):
+    """Sum the latency bucket counts of `stage` over several samples"""
+    counts = [0] * (len(Histogram.buckets) + 1)
+    for sample in samples:
+        for i, count in enumerate(sample['latency'].get(stage, ())):
+            counts[i] += count
+    return counts
+
+
+def growth_rate(samples, key):
+    """Least squares slope of `key` per hour of pen time over `samples`"""
+    hours = [sample['hours'] for sample in samples]
+    values = [sample[key] for sample in samples]
+    mean_hours, mean_value = statistics.mean(hours), statistics.mean(values)
+    spread = sum((h - mean_hours) ** 2 for h in hours)
+    if not spread:
+        return 0.
+    return sum(
+        (h - mean_hours) * (v - mean_value) for h, v in zip(hours, values)
+    ) / spread
+
+
+def bench_soak(args):
+    """Run hours of pen traffic through the full pipeline and check for drift"""
+    rm = reMarkable2()
+    if args.recording:
+        frames = load_recording(args.recording)
+        frame_seconds = (frames[-1].time - frames[0].time) / max(len(frames) - 1, 1)
+    else:
+        frames = synthetic_recording(args.segment, args.rate)
+        frame_seconds = 1 / args.rate
+    segments = max(1, round(args.hours * 3600 / (len(frames) * frame_seconds)))
+    total = segments * len(frames)
+    print(f"{total} frames ({segments * len(frames) * frame_seconds / 3600:.2f}h of pen time) "
+          f"in {segments} connections, {args.samples} samples")
+
+    # each stall logs a warning, they are expected here
+    logging.getLogger('remouse').setLevel(logging.ERROR)
+    stats = Stats()
+    sink = SoakSink(rm, stats, max(total // args.samples, 1), frame_seconds)
+    source = SoakSource(frame_events(rm, frames), segments)
+    tablet = Tablet(
+        functools.partial(SoakTablet, source),
+        lambda rm: Predictor(JitterFilter(sink, stats=stats), lead=0.02),
+        stats=stats,
+        stall_timeout=args.stall_timeout,
+        latency=True,
+    )
+    tracemalloc.start()
+    start = time.monotonic()
+    try:
+        asyncio.run(tablet.run())
+        gc.collect()
+        final = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__)])
+    finally:
+        tracemalloc.stop()
+    elapsed = time.monotonic() - start
+
+    print('{: >7} {: >9} {: >11} {: >5} {: >16} {: >10} {: >10}'.format(
+        'hours', 'rss MiB', 'traced KiB', 'fds', 'gc collections', 'decode p99', 'inject p99'
+    ))
+    for sample in sink.samples:
+        print('{: >7.2f} {: >9} {: >11.1f} {: >5} {: >16} {: >10} {: >10}'.format(
+            sample['hours'],
+            '-' if sample['rss'] is None else f"{sample['rss'] / 2**20:.1f}",
+            sample['traced'] / 1024,
+            '-' if sample['fds'] is None else sample['fds'],
+            '/'.join(map(str, sample['collections'])),
+            *(
+                '{:.3f}ms'.format(quantile(sample['latency'].get(stage, []), 0.99) * 1000)
+                if any(sample['latency'].get(stage, [])) else '-'
+                for stage in ('decode', 'inject')
+            ),
+        ))
+    print(f"{stats.frames} frames, {stats.suppressed} suppressed, {stats.reconnects} reconnects in {elapsed:.1f}s "
+          f"({stats.frames / elapsed:.0f} frames/s)")
+
+    # the first quarter is warm up.  Memory is sampled after a collection,
+    # so a leak, even a small one per reconnect, shows up as a steady slope
+    # over the rest, while latency is compared between the first and last
+    # quarter
+    quarter = max(len(sink.samples) // 4, 1)
+    before, after = sink.samples[:quarter], sink.samples[-quarter:]
+    first, last = sink.samples[0], sink.samples[-1]
+    measured = sink.samples[quarter:] if len(sink.samples) > quarter + 1 else sink.samples
+    failures = []
+    if stats.frames + stats.suppressed != total:
+        failures.append(f"{total - stats.frames - stats.suppressed} frames lost")
+    if stats.reconnects != segments - 1:
+        failures.append(f"{stats.reconnects} reconnects, expected {segments - 1}")
+    growth = growth_rate(measured, 'traced') / 1024
+    summary = f"Python memory growth {growth:.1f} KiB/h"
+    if first['rss'] is not None:
+        rss_growth = growth_rate(measured, 'rss') / 2**20
+        summary += f", RSS growth {rss_growth:.2f} MiB/h"
+        if rss_growth > args.max_rss_growth:
+            failures.append(f"RSS grew by {rss_growth:.2f} MiB/h")
+    print(summary)
+    if growth > args.max_growth:
+        failures.append(f"Python memory grew by {growth:.1f} KiB/h")
+        for stat in final.compare_to(sink.snapshot, 'lineno')[:5]:
+            print(stat)
+    if first['fds'] is not None and last['fds'] > first['fds']:
+        failures.append(f"{last['fds'] - first['fds']} file descriptors leaked")
+    for stage in last['latency']:
+        start = quantile(merge_windows(before, stage), 0.99)
+        end = quantile(merge_windows(after, stage), 0.99)
+        if start and end and end > start * args.max_drift:
+            failures.append(f"{stage} p99 drifted from {start * 1000:.3f}ms to {end * 1000:.3f}ms")
+    if failures:
+        raise SystemExit('\n'.join(failures))
+    print("no drift")
+
+
+class NullSink:
+    """End of a pipeline which only counts frames"""
+
+    def __init__(self):
+        self.frames = 0
+
+    def send(self, frame):
+        self.frames += 1
+
+    def send_batch(self, frames):
+        self.frames += len(frames)
+
+
+class MappingStage:
+    """The remap done by output backends, as a stage of its own"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.mapping = Mapping(reMarkable2(), Monitor(0, 0, 1920, 1080), 'fill', 'right')
+
+    def send(self, frame):
+        self.mapping(frame.x, frame.y)
+        self.sink.send(frame)
+
+    def send_batch(self, frames):
+        mapping = self.mapping
+        for frame in frames:
+            mapping(frame.x, frame.y)
+        self.sink.send_batch(frames)
+
+
+def time_stage(make_stage, frames, batch_size, repeat=5):
+    """Fastest time per frame of a stage fed frame by frame and in batches
+
+    Args:
+        make_stage (function): takes the next stage and returns the stage
+            under test
+        frames (list): PenFrames to send
+        batch_size (int): frames per send_batch() call
+
+    Returns:
+        (float, float): seconds per frame with send() and with send_batch()
+    """
+    single = batch = float('inf')
+    for _ in range(repeat):
+        # stages may change batches in place, so each run gets fresh copies
+        copies = FrameBatch()
+        for frame in frames:
+            copies.add(frame)
+        batches = [
+            copies.frames[i:i + batch_size] for i in range(0, len(frames), batch_size)
+        ]
+
+        send = make_stage(NullSink()).send
+        start = time.perf_counter()
+        for frame in frames:
+            send(frame)
+        single = min(single, time.perf_counter() - start)
+
+        send_batch = batched(make_stage(NullSink()))
+        start = time.perf_counter()
+        for chunk in batches:
+            send_batch(chunk)
+        batch = min(batch, time.perf_counter() - start)
+    return single / len(frames), batch / len(frames)
+
+
+def time_decode(rm, data, read_size, rules=None, repeat=5):
+    """Fastest time to decode `data` arriving `read_size` bytes at a time"""
+    event = struct.Struct(rm.e_format)
+    chunks = [bytearray(data[i:i + read_size]) for i in range(0, len(data), read_size)]
+    best = float('inf')
+    for _ in range(repeat):
+        assembler = FrameAssembler(rules=rules)
+        batch = FrameBatch()
+        start = time.perf_counter()
+        for chunk in chunks:
+            decode(chunk, len(chunk), event, assembler, batch)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_stages(args):
+    """Time each pipeline stage on its own, and some orderings of them"""
+    rm = reMarkable2()
+    frames = synthetic_recording(args.frames / 500)
+    data = frame_events(rm, frames)
+    state_dir = tempfile.mkdtemp()
+    # recorders and state writers, to close afterwards
+    closing = []
+
+    def record(sink):
+        closing.append(Recorder(sink, os.devnull))
+        return closing[-1]
+
+    def state(sink):
+        closing.append(StateWriter(os.path.join(state_dir, str(len(closing))), lambda rm: sink))
+        return closing[-1].bind(rm)
+
+    stages = {
+        'remap': MappingStage,
+        'jitter': lambda sink: JitterFilter(sink, stats=Stats()),
+        'predict': lambda sink: Predictor(sink, lead=0.02),
+        'record': record,
+        'state': state,
+        'jitter>predict': lambda sink: JitterFilter(Predictor(sink, lead=0.02), stats=Stats()),
+        'predict>jitter': lambda sink: Predictor(JitterFilter(sink, stats=Stats()), lead=0.02),
+    }
+
+    print(f"{len(frames)} frames, batches of {args.batch}")
+    print('{: <16} {: >12} {: >12} {: >8}'.format('stage', 'frame ns', 'batch ns', 'speedup'))
+    # the decoder works on reads, of one frame's events or a batch's worth
+    e_sz = struct.calcsize(rm.e_format)
+    frame_size = len(data) // len(frames) // e_sz * e_sz
+    # one of each kind of rule, the clamp applies to every frame
+    rules = EventRules(['map BTN_STYLUS BTN_RIGHT', 'drop ABS_DISTANCE', 'clamp ABS_PRESSURE 0 3000'])
+    rows = [
+        (name, *(
+            time_decode(rm, data, size, decode_rules) / len(frames)
+            for size in (frame_size, frame_size * args.batch)
+        ))
+        for name, decode_rules in (('decode', None), ('decode rules', rules))
+    ]
+    for name, make_stage in stages.items():
+        rows.append((name, *time_stage(make_stage, frames, args.batch)))
+    for stage in closing:
+        stage.close()
+    os.rmdir(state_dir)
+
+    for name, single, batch in rows:
+        print('{: <16} {: >12.0f} {: >12.0f} {: >7.2f}x'.format(
+            name, single * 1e9, batch * 1e9, single / batch
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="remarkable_mouse benchmarks using a synthetic tablet")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    ring = subparsers.add_parser('ring', help="frame latency and jitter with and without a reader process")
+    ring.add_argument('--rate', default=500, type=float, help="frames per second (default 500)")
+    ring.add_argument('--seconds', default=10, type=float, help="length of each run (default 10)")
+    ring.add_argument('--load', default=2, type=int, help="CPU-bound threads competing for the GIL (default 2)")
+    ring.set_defaults(func=bench_ring)
+
+    predict = subparsers.add_parser('predict', help="prediction error of each motion model against a recording made with remouse --record")
+    predict.add_argument('recording', nargs='?', help="file written by remouse --record (default synthetic)")
+    predict.add_argument('--lead', default=30, type=float, help="milliseconds to predict ahead (default 30)")
+    predict.add_argument('--smoothing', default=0.5, type=float, help="weight of the newest sample in the estimates (default 0.5)")
+    predict.set_defaults(func=bench_predict)
+
+    alloc = subparsers.add_parser('alloc', help="memory retained per frame by the read loop, fails above --limit")
+    alloc.add_argument('--frames', default=40000, type=int, help="number of synthetic frames (default 40000)")
+    alloc.add_argument('--limit', default=0.1, type=float, help="bytes per frame allowed to be retained (default 0.1)")
+    alloc.set_defaults(func=bench_alloc)
+
+    soak = subparsers.add_parser('soak', help="hours of pen traffic through the full pipeline, fails if memory grows or latency drifts")
+    soak.add_argument('recording', nargs='?', help="file written by remouse --record, replayed in a loop (default synthetic)")
+    soak.add_argument('--hours', default=1, type=float, help="pen time to simulate, run as fast as the pipeline allows (default 1)")
+    soak.add_argument('--rate', default=500, type=float, help="synthetic frames per second of pen time (default 500)")
+    soak.add_argument('--segment', default=60, type=float, help="seconds of synthetic pen time per connection before it stalls and reconnects (default 60)")
+    soak.add_argument('--samples', default=20, type=int, help="number of resource samples (default 20)")
+    soak.add_argument('--stall-timeout', default=0.1, type=float, help="seconds before a stalled connection is replaced (default 0.1)")
+    soak.add_argument('--max-growth', default=16, type=float, help="KiB of Python memory growth allowed per hour of pen time after warm up (default 16)")
+    soak.add_argument('--max-rss-growth', default=4, type=float, help="MiB of RSS growth allowed per hour of pen time after warm up (default 4)")
+    soak.add_argument('--max-drift', default=2, type=float, help="allowed ratio of p99 stage latency at the end to the start (default 2)")
+    soak.set_defaults(func=bench_soak)
+
+    stages = subparsers.add_parser('stages', help="time of each pipeline stage per frame, fed frame by frame and in batches")
+    stages.add_argument('--frames', default=20000, type=int, help="number of synthetic frames (default 20000)")
+    stages.add_argument('--batch', default=4, type=int, help="frames per batch, about the frames arriving in one read (default 4)")
+    stages.set_defaults(func=bench_stages)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
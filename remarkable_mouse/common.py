@@ -4,9 +4,11 @@ from collections import namedtuple
 import logging
 import struct
 import sys
+import time
 from screeninfo import get_monitors, Monitor
 
 from .codes import codes, types
+from .transport import ChannelStream, open_tcp_stream, tcp_port
 
 logging.basicConfig(format='%(message)s')
 log = logging.getLogger('remouse')
@@ -14,6 +16,49 @@ log = logging.getLogger('remouse')
 # ev settings
 ev = namedtuple('ev_setting', ['min', 'max', 'res'])
 
+class StallError(Exception):
+    """Raised when a tablet stream stops delivering data mid-stroke"""
+
+class Watchdog:
+    """Detect a half-dead connection by watching the pen stream
+
+    While the pen is in proximity the tablet reports continuously, so a gap in
+    incoming data longer than `timeout` means the link has stalled.
+
+    Args:
+        timeout (float): seconds without data before declaring a stall
+            (0 disables the watchdog)
+        stats (Stats, optional): counters to update when a stall is detected
+    """
+
+    def __init__(self, timeout, stats=None):
+        self.timeout = timeout
+        self.stats = stats
+        self.in_proximity = False
+        self.last_data = time.monotonic()
+
+    def feed(self, nbytes):
+        """Record that `nbytes` bytes arrived from the stream"""
+        self.last_data = time.monotonic()
+        if self.stats is not None:
+            self.stats.bytes += nbytes
+
+    def proximity(self, value):
+        """Record whether the pen or eraser is in range"""
+        self.in_proximity = bool(value)
+
+    def check(self):
+        """Raise StallError if the pen is in range but no data is arriving"""
+        if (
+            self.timeout > 0 and self.in_proximity and
+            time.monotonic() - self.last_data > self.timeout
+        ):
+            if self.stats is not None:
+                self.stats.stalls += 1
+            raise StallError(
+                f"No data for {self.timeout}s while pen was in proximity"
+            )
+
 class reMarkable1:
     """Class holding some input settings for a reMarkable tablet
 
@@ -63,26 +108,52 @@ class reMarkable1:
     pen_tilt_x = ev(-6400, 6400, 6400) # pen tilt angle (ABS_TILT_X)
     pen_tilt_y = ev(-6400, 6400, 6400) # pen tilt angle (ABS_TILT_Y)
 
-    def __init__(self, client=None):
+    def __init__(self, client=None, tcp=False, tcp_remote=False):
         self.client = client
+        self.tcp = tcp
+        self.tcp_remote = tcp_remote
+
+    def open_stream(self, path, port):
+        """Open a stream of raw evdev events from a device file
+
+        Args:
+            path (str): input device on the tablet
+            port (int): TCP port to use if plain TCP streaming is enabled
+
+        Returns:
+            (ChannelStream or TCPStream)
+        """
+        cmd = f'dd bs={self.e_sz} if={path}'
+        if self.tcp:
+            try:
+                return open_tcp_stream(self.client, cmd, port, allow_remote=self.tcp_remote)
+            except OSError as e:
+                log.warning(f"TCP streaming failed ({e}), falling back to SSH")
+        return ChannelStream(
+            self.client.exec_command(cmd, bufsize=self.e_sz, timeout=0)[1]
+        )
 
     @property
     def pen(self):
-        """(paramiko.ChannelFile) pen stream"""
-        cmd = f'dd bs={self.e_sz} if={self.pen_file}'
-        return self.client.exec_command(cmd, bufsize=self.e_sz, timeout=0)[1]
+        """(ChannelStream or TCPStream) pen stream"""
+        return self.open_stream(self.pen_file, tcp_port)
 
     @property
     def touch(self):
-        """(paramiko.ChannelFile) touch stream"""
-        cmd = f'dd bs={self.e_sz} if={self.touch_file}'
-        return self.client.exec_command(cmd, bufsize=self.e_sz, timeout=0)[1]
+        """(ChannelStream or TCPStream) touch stream"""
+        return self.open_stream(self.touch_file, tcp_port + 1)
 
     @property
     def button(self):
-        """(paramiko.ChannelFile) button stream"""
-        cmd = f'dd bs={self.e_sz} if={self.button_file}'
-        return self.client.exec_command(cmd, bufsize=self.e_sz, timeout=0)[1]
+        """(ChannelStream or TCPStream) button stream"""
+        return self.open_stream(self.button_file, tcp_port + 2)
+
+    def touch_to_pen(self, x, y):
+        """convert touchscreen coordinates to pen coordinates"""
+        return (
+            y * self.pen_x.max / self.touch_y.max,
+            (self.touch_x.max - x) * self.pen_y.max / self.touch_x.max,
+        )
 
     def remap(self, x, y, max_x, max_y, monitor_width,
             monitor_height, mode, orientation):
@@ -163,6 +234,13 @@ class reMarkablePro(reMarkable1):
     pen_tilt_x = ev(-9000, 9000, None) # pen tilt angle (ABS_TILT_X)
     pen_tilt_y = ev(-9000, 9000, None) # pen tilt angle (ABS_TILT_Y)
 
+    def touch_to_pen(self, x, y):
+        """convert touchscreen coordinates to pen coordinates"""
+        return (
+            x * self.pen_x.max / self.touch_x.max,
+            y * self.pen_y.max / self.touch_y.max,
+        )
+
     def remap(self, x, y, max_x, max_y, monitor_width,
             monitor_height, mode, orientation):
         """remap pen coordinates to screen coordinates
@@ -199,12 +277,92 @@ class reMarkablePro(reMarkable1):
             scaling_y * (y - (max_y - monitor_height / scaling_y) / 2)
         )
 
+# supported models by class name
+models = {m.__name__: m for m in (reMarkable1, reMarkable2, reMarkablePro)}
+
+def model_name(rm):
+    """Name of the supported model `rm` is, or is derived from"""
+    return next(m.__name__ for m in type(rm).__mro__ if m in models.values())
+
+
+class Mapping:
+    """Cached transform from tablet coordinates to screen coordinates
+
+    `remap` is affine for every model, so it is sampled once here and each
+    frame only costs two multiply-adds per axis.
+
+    Args:
+        rm (reMarkable): tablet settings
+        monitor (screeninfo.Monitor): output area
+        mode (str): mapping mode
+        orientation (str): tablet orientation
+        touch (bool): map touchscreen instead of pen coordinates
+    """
+
+    def __init__(self, rm, monitor, mode, orientation, touch=False):
+        def remap(x, y):
+            if touch:
+                x, y = rm.touch_to_pen(x, y)
+            return rm.remap(
+                x, y,
+                rm.pen_x.max, rm.pen_y.max,
+                monitor.width, monitor.height,
+                mode, orientation,
+            )
+
+        ox, oy = remap(0, 0)
+        xx, xy = remap(1, 0)
+        yx, yy = remap(0, 1)
+        self.coeffs = (
+            xx - ox, yx - ox, ox + monitor.x,
+            xy - oy, yy - oy, oy + monitor.y,
+        )
+
+    def scale(self, sx, sy):
+        """Scale the output of this mapping in place, e.g. into device units"""
+        a, b, c, d, e, f = self.coeffs
+        self.coeffs = (a * sx, b * sx, c * sx, d * sy, e * sy, f * sy)
+        return self
+
+    def __call__(self, x, y):
+        a, b, c, d, e, f = self.coeffs
+        return a * x + b * y + c, d * x + e * y + f
+
+
+# monitors as of the last query, see refresh_layout()
+layout = None
+
+
+def geometry(monitors):
+    return tuple((m.x, m.y, m.width, m.height) for m in monitors)
+
+
+def refresh_layout():
+    """Query the monitor layout again
+
+    Returns:
+        bool: whether the geometry changed since the last query
+    """
+    global layout
+    monitors = get_monitors()
+    changed = layout is None or geometry(monitors) != geometry(layout)
+    layout = monitors
+    return changed
+
+
+def get_layout():
+    """Cached monitor layout, queried on first use"""
+    if layout is None:
+        refresh_layout()
+    return layout
+
 
 def get_monitor(region, monitor_num, orientation):
     """ Get info of where we want to map the tablet to
 
     Args:
-        region (boolean): whether to prompt the user to select a region
+        region (boolean or tuple): whether to prompt the user to select a
+            region, or an already selected (x, y, width, height)
         monitor_num (int): index of monitor to use.  Implies region=False
         orientation (str): Location of tablet charging port.
             ('top', 'bottom', 'left', 'right')
@@ -212,27 +370,34 @@ def get_monitor(region, monitor_num, orientation):
     Returns:
         screeninfo.Monitor
         (width, height): total size of all screens put together
+
+    Raises:
+        ValueError: there is no monitor `monitor_num`
     """
 
+    monitors = get_layout()
+
     # compute size of box encompassing all screens
     max_x, max_y = 0, 0
-    for m in get_monitors():
+    for m in monitors:
         x = m.x + m.width
         y = m.y + m.height
         max_x = max(x, max_x)
         max_y = max(y, max_y)
 
     if region:
-        x, y, width, height = get_region(orientation)
+        if region is True:
+            region = get_region(orientation)
+        x, y, width, height = region
         monitor = Monitor(
             x, y, width, height,
             name="Fake monitor from region selection"
         )
     else:
         try:
-            monitor = get_monitors()[monitor_num]
+            monitor = monitors[monitor_num]
         except IndexError:
-            log.error(f"Monitor {monitor_num} not found.  Only {len(get_monitors())} detected.")
+            raise ValueError(f"Monitor {monitor_num} not found.  Only {len(monitors)} detected.")
 
     log.debug(f"Chose monitor: {monitor}")
     log.debug(f"Screen size: ({max_x}, {max_y})")
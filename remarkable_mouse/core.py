@@ -0,0 +1,405 @@
+import asyncio
+import logging
+import signal
+import socket
+import struct
+
+import paramiko
+from screeninfo import ScreenInfoError
+
+from .common import StallError, Watchdog, log_event, model_name, refresh_layout
+from .frames import (
+    TOOL_PEN, TOOL_RUBBER, FrameAssembler, FrameBatch, HoverPolicy, abs_fields, batched
+)
+from .metrics import LatencyTrack
+from .stats import Stats
+from .touch import TouchTracker
+from .trace import TeeTrack, now, trace_sink
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+
+async def race(*coros):
+    """Run coroutines until the first one finishes, then cancel the rest
+
+    Returns:
+        result of the first coroutine to finish (exceptions are re-raised)
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        return done.pop().result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def read_chunks(stream, e_sz, watchdog, track=None):
+    """Read raw events as they arrive
+
+    Args:
+        stream (ChannelStream or TCPStream): raw event stream
+        e_sz (int): size of one event
+        watchdog (Watchdog): stall detector, fed with every read
+        track (Track, optional): records a span for each read
+
+    Yields:
+        (bytearray, int): buffer starting with whole events and their total
+            length, valid until the next iteration.  A trailing partial
+            event is kept for the next chunk
+    """
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    fd = stream.fileno()
+    loop.add_reader(fd, ready.set)
+
+    buf = bytearray(e_sz * 256)
+    view = memoryview(buf)
+    filled = 0
+
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+
+            start = now()
+            try:
+                n = stream.recv_into(view[filled:])
+            except (socket.timeout, BlockingIOError):
+                continue
+            if track is not None:
+                track.span('read', start, now(), {'bytes': n})
+            if n == 0:
+                raise EOFError("Stream closed")
+            watchdog.feed(n)
+            filled += n
+
+            end = filled - filled % e_sz
+            yield buf, end
+            view[:filled - end] = view[end:filled]
+            filled -= end
+    finally:
+        loop.remove_reader(fd)
+
+
+def decode(buf, end, event, assembler, batch, debug=False):
+    """Decode the events in buf[:end] and assemble them into frames
+
+    Args:
+        buf (bytearray): raw events
+        end (int): length of the whole events in `buf`
+        event (struct.Struct): event layout of the tablet
+        assembler (FrameAssembler): turns events into frames
+        batch (FrameBatch): cleared, then filled with the completed frames
+        debug (bool): log every event
+
+    Returns:
+        list of PenFrame: batch.frames
+    """
+    batch.clear()
+    for offset in range(0, end, event.size):
+        e = event.unpack_from(buf, offset)
+        if debug:
+            log_event(*e)
+        if assembler.feed(*e):
+            batch.add(assembler.frame)
+    return batch.frames
+
+
+async def read_stream(stream, rm, assembler, sink, *, stats, watchdog, track=None):
+    """Read evdev events as they arrive and pass completed frames to a sink
+
+    All frames completed by one read are passed on together as a batch.
+
+    Args:
+        stream (ChannelStream or TCPStream): raw event stream
+        rm (reMarkable): tablet settings
+        assembler (FrameAssembler): turns events into frames
+        sink: output backend, called as sink.send_batch(frames), or
+            sink.send(frame) for each frame if it takes no batches
+        stats (Stats): session counters
+        watchdog (Watchdog): stall detector
+        track (Track, optional): records spans of each stage, and the
+            number of bytes waiting to be read (also kept in stats.backlog)
+    """
+    event = struct.Struct(rm.e_format)
+    e_sz = event.size
+    debug = log.level == logging.DEBUG
+    batch = FrameBatch()
+    send_batch = batched(sink)
+
+    chunks = read_chunks(stream, e_sz, watchdog, track)
+    try:
+        async for buf, end in chunks:
+            if track is not None:
+                start = now()
+            frames = decode(buf, end, event, assembler, batch, debug)
+            stats.events += end // e_sz
+            if track is not None:
+                t = now()
+                track.span('decode', start, t, {'events': end // e_sz})
+            if frames:
+                stats.frames += len(frames)
+                # either end of the pen keeps the tablet reporting
+                watchdog.proximity(frames[-1].buttons & (TOOL_PEN | TOOL_RUBBER))
+                send_batch(frames)
+            if track is not None:
+                end_time = now()
+                if frames:
+                    track.span('inject', t, end_time, {'frames': len(frames)})
+                if hasattr(stream, 'pending'):
+                    stats.backlog = stream.pending()
+                    track.counter('backlog', end_time, {'bytes': stats.backlog})
+    finally:
+        # stop watching the stream now, even if the sink raised
+        await chunks.aclose()
+
+
+async def read_touch(stream, rm, tracker, send_touch, *, stats):
+    """Read touchscreen events and pass changed slots on each report
+
+    Args:
+        stream (ChannelStream or TCPStream): raw touch event stream
+        rm (reMarkable): tablet settings
+        tracker (TouchTracker): multitouch slot state
+        send_touch (function): called with the tracker after each report,
+            must call tracker.clear() once it has used the changes
+        stats (Stats): session counters
+    """
+    event = struct.Struct(rm.e_format)
+    e_sz = event.size
+
+    # touch data doesn't count towards pen stall detection
+    chunks = read_chunks(stream, e_sz, Watchdog(0))
+    try:
+        async for buf, end in chunks:
+            for offset in range(0, end, e_sz):
+                stats.touch_events += 1
+                if tracker.feed(*event.unpack_from(buf, offset)):
+                    stats.touch_frames += 1
+                    send_touch(tracker)
+    finally:
+        await chunks.aclose()
+
+
+async def watch(watchdog):
+    """Periodically check a watchdog, raising StallError on a stall"""
+    if watchdog.timeout <= 0:
+        await asyncio.Future()
+    while True:
+        await asyncio.sleep(watchdog.timeout / 4)
+        watchdog.check()
+
+
+async def report_stats(tablets, interval):
+    """Log stats of every tablet each `interval` seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        for tablet in tablets:
+            tablet.stats.report()
+
+
+async def watch_layout(poll, on_change):
+    """Re-query the monitor layout every `poll` seconds
+
+    The query runs in an executor, never on the event path, and `on_change`
+    is only called when the geometry actually changed.  If it raises
+    ValueError, e.g. because a mapped monitor was unplugged, the previous
+    mappings stay in place.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(poll)
+        try:
+            changed = await loop.run_in_executor(None, refresh_layout)
+        except ScreenInfoError as e:
+            log.debug(f"Could not query monitors: {e}")
+            continue
+        if changed:
+            log.info("Monitor layout changed")
+            try:
+                on_change()
+            except ValueError as e:
+                log.error(f"Keeping previous mapping: {e}")
+
+
+async def pipe_stream(stream, rm, sink, *, stats, watchdog, assembler=None, touch=None,
+                      track=None):
+    """Pipe one stream into a sink until it closes or stalls
+
+    If a `touch` stream is given, it's piped into sink.send_touch alongside.
+    Pen events are assembled by `assembler`, by default a new FrameAssembler
+    without hover policy or rules.
+    """
+    coros = [
+        read_stream(
+            stream, rm, assembler or FrameAssembler(), sink,
+            stats=stats, watchdog=watchdog, track=track
+        ),
+        watch(watchdog),
+    ]
+    if touch is not None:
+        coros.append(read_touch(touch, rm, TouchTracker(rm), sink.send_touch, stats=stats))
+    await race(*coros)
+
+
+class Tablet:
+    """A tablet connection feeding an output backend
+
+    The connection is reopened whenever the stream stalls, while the sink
+    (and any virtual device it owns) is kept.  So is the pen state: the
+    tablet only reports changes, so after a reconnect it doesn't resend
+    e.g. BTN_TOOL_PEN for a pen which stayed in range.
+
+    Args:
+        connect (function): blocking function returning a connected reMarkable
+        make_sink (function): takes a reMarkable and returns an output backend
+            with a send(frame) and optionally a send_batch(frames) method
+        stats (Stats): session counters
+        stall_timeout (float): seconds without data before reconnecting
+        hover_rate (float): maximum frames per second while hovering (0 for
+            no limit).  Hover frames which only change fields the sink
+            doesn't list in its `fields` attribute are always dropped
+        touch (bool): also forward the touchscreen, if the sink has a
+            send_touch method
+        tracer (Tracer, optional): records pipeline spans on a track named
+            after the tablet
+        latency (bool): keep histograms of pipeline stage times in
+            `stats.latency`
+        rules (EventRules, optional): how pen events update frames
+    """
+
+    def __init__(self, connect, make_sink, *, stats, stall_timeout, hover_rate=0,
+                 touch=False, tracer=None, latency=False, rules=None):
+        self.connect = connect
+        self.make_sink = make_sink
+        self.stats = stats
+        self.stall_timeout = stall_timeout
+        self.hover_rate = hover_rate
+        self.touch = touch
+        self.tracer = tracer
+        self.latency = latency
+        self.rules = rules
+        self.track = None
+        self.sink = None
+        self.assembler = None
+
+    @property
+    def fields(self):
+        """PenFrame attributes used by the sink"""
+        return getattr(self.sink, 'fields', tuple(abs_fields.values()))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # SSH setup blocks, so keep it off the event loop
+            try:
+                rm = await loop.run_in_executor(None, self.connect)
+            except (socket.error, paramiko.ssh_exception.SSHException) as e:
+                if self.stats.reconnects == 0:
+                    raise
+                log.warning(f"Reconnect failed: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            self.stats.settings['model'] = model_name(rm)
+            if self.sink is None:
+                self.sink = self.make_sink(rm)
+                tracks = []
+                if self.tracer is not None:
+                    tracks.append(self.tracer.track(self.stats.settings.get('address', 'tablet')))
+                if self.latency:
+                    tracks.append(LatencyTrack(self.stats))
+                if tracks:
+                    self.track = tracks[0] if len(tracks) == 1 else TeeTrack(tracks)
+                    trace_sink(self.sink, self.track)
+                self.assembler = FrameAssembler(
+                    HoverPolicy(self.hover_rate, self.fields, self.stats), self.rules
+                )
+
+            stream = touch = None
+            try:
+                stream = await loop.run_in_executor(None, lambda: rm.pen)
+                if self.touch and getattr(self.sink, 'send_touch', None) is not None:
+                    touch = await loop.run_in_executor(None, lambda: rm.touch)
+                await pipe_stream(
+                    stream, rm, self.sink,
+                    stats=self.stats,
+                    watchdog=Watchdog(self.stall_timeout, self.stats),
+                    assembler=self.assembler,
+                    touch=touch,
+                    track=self.track,
+                )
+            except StallError as e:
+                log.warning(f"{e}, reconnecting")
+                self.stats.reconnects += 1
+            except EOFError:
+                log.info(f"Connection to {self.stats.settings.get('address', 'tablet')} closed")
+                return
+            finally:
+                if stream is not None:
+                    stream.close()
+                if touch is not None:
+                    touch.close()
+                if rm.client is not None:
+                    rm.client.close()
+
+
+async def run(tablets, *, interval=0, reload=None, layout_poll=0, handlers=None, metrics=None,
+              top=None):
+    """Serve tablets until all disconnect or the process is asked to stop
+
+    All tablets share this event loop, so serving another tablet costs one
+    more set of coroutines rather than another process.
+
+    Args:
+        tablets (list): Tablet instances
+        interval (float): seconds between stats reports (0 disables them)
+        reload (function, optional): called on SIGHUP.  Signal handlers run
+            between loop callbacks, so it never sees a half delivered frame
+        layout_poll (float): seconds between monitor layout checks, `reload`
+            is also called when the layout changes (0 disables checks)
+        handlers (dict, optional): more signal handlers by signal name,
+            e.g. {'SIGUSR1': tracer.flush}
+        metrics (MetricsExporter, optional): serves the stats of `tablets`
+            while they run
+        top (TopView, optional): shown while the tablets run, quitting it
+            ends the session
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        if reload is not None:
+            loop.add_signal_handler(signal.SIGHUP, reload)
+        for name, handler in (handlers or {}).items():
+            loop.add_signal_handler(getattr(signal, name), handler)
+    except (NotImplementedError, AttributeError):
+        # no signal handlers in the Windows event loop
+        pass
+
+    coros = [asyncio.gather(*(t.run() for t in tablets))]
+    if interval > 0:
+        coros.append(report_stats(tablets, interval))
+    if layout_poll > 0 and reload is not None:
+        coros.append(watch_layout(layout_poll, reload))
+    if top is not None:
+        coros.append(top.run())
+    coros.append(stop.wait())
+    if metrics is None:
+        await race(*coros)
+        return
+    metrics.start()
+    try:
+        await race(*coros, metrics.publish())
+    finally:
+        metrics.close()
+
+
+def read_tablet(rm, sink, *, stats=None, watchdog=None):
+    """Blocking helper to pipe the pen stream of `rm` into `sink`"""
+    stats = stats or Stats()
+    watchdog = watchdog or Watchdog(0, stats)
+    asyncio.run(pipe_stream(rm.pen, rm, sink, stats=stats, watchdog=watchdog))
@@ -0,0 +1,140 @@
+import bisect
+import logging
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+# curves map 0-1 onto 0-1 and are only evaluated when building tables
+
+
+def linear(u):
+    return u
+
+
+def gamma(g):
+    """Curve u**g, below 1 makes light strokes heavier"""
+    return lambda u: u ** g
+
+
+def scale(s):
+    """Curve u*s, clipped to 1"""
+    return lambda u: min(u * s, 1)
+
+
+def piecewise(points):
+    """Curve through (x, y) points, linear in between
+
+    Args:
+        points (list): (x, y) pairs in 0-1
+    """
+    points = sorted(points)
+    xs = [x for x, _ in points]
+
+    def curve(u):
+        i = bisect.bisect_right(xs, u)
+        if i == 0:
+            return points[0][1]
+        if i == len(points):
+            return points[-1][1]
+        (x0, y0), (x1, y1) = points[i - 1], points[i]
+        return y0 + (u - x0) / (x1 - x0) * (y1 - y0)
+
+    return curve
+
+
+def load_curve(path):
+    """Piecewise curve from a file of 'x y' lines, # starts a comment"""
+    points = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                x, y = map(float, line.split())
+                points.append((x, y))
+    return piecewise(points)
+
+
+def parse_curve(spec):
+    """Curve from a command line setting
+
+    Args:
+        spec (str): 'linear', 'gamma:G', 'scale:S',
+            'points:X,Y;X,Y;...' or 'file:PATH'
+
+    Returns:
+        function mapping 0-1 onto 0-1
+
+    Raises:
+        ValueError: malformed spec
+    """
+    kind, _, arg = spec.partition(':')
+    try:
+        if kind == 'linear':
+            return linear
+        elif kind in ('gamma', 'scale'):
+            value = float(arg)
+            if not value > 0:
+                raise ValueError(f"{kind} must be positive")
+            return gamma(value) if kind == 'gamma' else scale(value)
+        elif kind == 'points':
+            return piecewise([
+                tuple(map(float, point.split(','))) for point in arg.split(';')
+            ])
+        elif kind == 'file':
+            return load_curve(arg)
+    except (ValueError, OSError) as e:
+        raise ValueError(f"invalid curve '{spec}': {e}")
+    raise ValueError(f"unknown curve '{spec}'")
+
+
+def pressure_table(curve, info, threshold=0):
+    """Output pressure for each raw pressure, indexed by raw - info.min
+
+    Pressure below `threshold` maps to 0 and the rest of the range is spread
+    over the full output range through `curve`.
+
+    Args:
+        curve (function): pressure curve
+        info (ev): range of the pressure axis
+        threshold (int): raw pressure needed for contact
+
+    Returns:
+        tuple of int
+    """
+    span = info.max - max(threshold, info.min)
+    table = []
+    for raw in range(info.min, info.max + 1):
+        if raw < threshold or span <= 0:
+            table.append(info.min)
+        else:
+            u = (raw - max(threshold, info.min)) / span
+            table.append(info.min + round(curve(u) * (info.max - info.min)))
+    return tuple(table)
+
+
+def contact_table(info, threshold, bit):
+    """`bit` for each raw pressure at or above `threshold`, else 0
+
+    Indexed by raw - info.min like pressure_table.
+    """
+    return tuple(
+        bit if raw >= threshold else 0
+        for raw in range(info.min, info.max + 1)
+    )
+
+
+def tilt_table(curve, info):
+    """Output tilt for each raw tilt, indexed by raw - info.min
+
+    `curve` is applied to the magnitude, so the table is symmetric about 0.
+
+    Returns:
+        tuple of int
+    """
+    limit = max(-info.min, info.max)
+    return tuple(
+        max(info.min, min(info.max, round(
+            (1 if raw >= 0 else -1) * curve(abs(raw) / limit) * limit
+        )))
+        for raw in range(info.min, info.max + 1)
+    )
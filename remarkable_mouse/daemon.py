@@ -0,0 +1,428 @@
+import asyncio
+import getpass
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+
+from .common import model_name, models
+from .core import run
+from .frames import PenFrame, batched
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+# sent once to each subscriber, followed by PenFrame records
+hello = struct.Struct('<4s16s')
+magic = b'RMF1'
+
+
+def default_socket(index=0):
+    """Path of the frame socket for the `index`th tablet of a daemon"""
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    suffix = f'-{index}' if index else ''
+    return os.path.join(directory, f'remouse-{getpass.getuser()}{suffix}.sock')
+
+
+class Subscriber(asyncio.Protocol):
+    """Connection to one local client of a FrameServer
+
+    While the client's socket buffer is full only the newest frame is kept,
+    so a slow client sees coalesced frames instead of slowing the tablet
+    stream down.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.paused = False
+        self.pending = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=PenFrame.record.size * 16)
+        self.server.subscribers.add(self)
+        if self.server.model is not None:
+            self.send_hello()
+        log.debug(f"Subscriber connected ({len(self.server.subscribers)} total)")
+
+    def connection_lost(self, exc):
+        self.server.subscribers.discard(self)
+        log.debug(f"Subscriber disconnected ({len(self.server.subscribers)} total)")
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.pending is not None:
+            self.transport.write(self.pending)
+            self.pending = None
+
+    def send_hello(self):
+        self.transport.write(hello.pack(magic, self.server.model.encode()))
+
+    def send(self, records):
+        """Write one or more frame records"""
+        if self.paused:
+            # keep only the latest frame until the subscriber catches up
+            size = PenFrame.record.size
+            self.server.stats.coalesced += len(records) // size - (self.pending is None)
+            self.pending = records[-size:]
+        else:
+            self.transport.write(records)
+
+
+class FrameServer:
+    """Publish frames to local subscribers over a UNIX domain socket
+
+    Each subscriber receives a hello record naming the tablet model followed
+    by one PenFrame.record per frame.
+
+    Args:
+        path (str): socket path
+        stats (Stats): counters for coalesced frames
+    """
+
+    def __init__(self, path, stats):
+        self.path = path
+        self.stats = stats
+        self.subscribers = set()
+        self.model = None
+        self.server = None
+        self.buf = bytearray(PenFrame.record.size)
+        self.batch_buf = bytearray()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_unix_server(
+            lambda: Subscriber(self), self.path
+        )
+        os.chmod(self.path, 0o600)
+        log.info(f"Publishing frames on {self.path}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            os.unlink(self.path)
+        for subscriber in list(self.subscribers):
+            subscriber.transport.close()
+
+    def bind(self, rm):
+        """Record the connected model, used as make_sink"""
+        self.model = model_name(rm)
+        for subscriber in self.subscribers:
+            subscriber.send_hello()
+        return self
+
+    def send(self, frame):
+        if not self.subscribers:
+            return
+        frame.pack_into(self.buf)
+        record = bytes(self.buf)
+        for subscriber in self.subscribers:
+            subscriber.send(record)
+
+    def send_batch(self, frames):
+        if not self.subscribers:
+            return
+        size = PenFrame.record.size
+        if len(self.batch_buf) < len(frames) * size:
+            self.batch_buf = bytearray(len(frames) * size)
+        for i, frame in enumerate(frames):
+            frame.pack_into(self.batch_buf, i * size)
+        # one write per subscriber for the whole batch
+        records = bytes(memoryview(self.batch_buf)[:len(frames) * size])
+        for subscriber in self.subscribers:
+            subscriber.send(records)
+
+
+def control_socket(path):
+    """Path of the control socket belonging to frame socket `path`"""
+    return path + '.ctl'
+
+
+def load_backend(name):
+    """Output backend class by name ('pynput' or 'evdev')"""
+    if name == 'evdev':
+        from .evdev import EvdevSink
+        return EvdevSink
+    elif name == 'pynput':
+        from .pynput import PynputSink
+        return PynputSink
+    raise ValueError(f"Unknown backend '{name}'")
+
+
+class Router:
+    """Daemon output: publish every frame and optionally drive a backend
+
+    The attached output keeps the mapping settings given with attach, the
+    daemon's own settings never override them.
+
+    Args:
+        server (FrameServer): publisher for local subscribers
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.rm = None
+        self.backend = None
+        self.output = None
+        self.send_output = None
+        # mapping settings of the attached output
+        self.settings = None
+
+    def bind(self, rm):
+        """Remember the connected tablet, used as make_sink"""
+        self.rm = rm
+        self.server.bind(rm)
+        return self
+
+    def send(self, frame):
+        self.server.send(frame)
+        if self.output is not None:
+            self.output.send(frame)
+
+    def send_batch(self, frames):
+        self.server.send_batch(frames)
+        if self.output is not None:
+            self.send_output(frames)
+
+    def attach(self, *, backend, **settings):
+        """Start or reconfigure local output
+
+        Changing only mapping settings of the running backend recomputes its
+        mapping, changing the backend replaces it.
+        """
+        if self.rm is None:
+            raise RuntimeError("Tablet not connected yet")
+        if settings.get('region') is True:
+            # the daemon can't show the region picker, the client selects it
+            raise ValueError("Region must be given as x, y, width, height")
+        if backend == self.backend and self.output is not None:
+            self.output.configure(**settings)
+        else:
+            self.output = load_backend(backend)(self.rm, **settings)
+            self.send_output = batched(self.output)
+            self.backend = backend
+        self.settings = settings
+        log.info(f"Attached {backend} output")
+
+    def configure(self, **settings):
+        """Recompute the mapping of the attached output, if any
+
+        Used when the monitor layout changes.  The attached output's own
+        settings are reapplied and `settings` from the daemon are ignored.
+        """
+        if self.output is not None:
+            self.output.configure(**self.settings)
+
+    def detach(self):
+        """Stop local output, frames are still published"""
+        self.output = self.backend = self.send_output = self.settings = None
+        log.info("Detached output")
+
+
+class ControlServer:
+    """Accept JSON commands on a UNIX domain socket
+
+    Each request is one JSON object per line with a 'cmd' key, and gets one
+    JSON object back: {"ok": ...} or {"error": "..."}.
+
+    Commands:
+        attach: start or reconfigure output, remaining keys are sink settings
+        detach: stop output
+        stats: return the tablet's Stats sample
+
+    Args:
+        path (str): socket path
+        router (Router): daemon output
+        stats (Stats): counters of the tablet
+    """
+
+    def __init__(self, path, router, stats):
+        self.path = path
+        self.router = router
+        self.stats = stats
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, self.path)
+        os.chmod(self.path, 0o600)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            os.unlink(self.path)
+
+    def dispatch(self, request):
+        cmd = request.pop('cmd', None)
+        if cmd == 'attach':
+            if isinstance(request.get('region'), list):
+                request['region'] = tuple(request['region'])
+            self.router.attach(**request)
+            self.stats.settings.update(mode=request['mode'], orientation=request['orientation'])
+            return True
+        elif cmd == 'detach':
+            self.router.detach()
+            return True
+        elif cmd == 'stats':
+            return self.stats.sample()
+        raise ValueError(f"Unknown command '{cmd}'")
+
+    async def handle(self, reader, writer):
+        try:
+            async for line in reader:
+                try:
+                    reply = {'ok': self.dispatch(json.loads(line))}
+                except Exception as e:
+                    log.debug(f"Control command failed: {e}")
+                    reply = {'error': str(e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def control(path, cmd, **args):
+    """Send one command to a daemon's control socket
+
+    Args:
+        path (str): control socket path
+        cmd (str): command name
+        args: command arguments
+
+    Returns:
+        command result
+
+    Raises:
+        OSError: the daemon isn't running or closed the connection
+        RuntimeError: the daemon couldn't run the command
+    """
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(dict(args, cmd=cmd)).encode() + b'\n')
+        line = sock.makefile('rb').readline()
+    if not line:
+        raise ConnectionError("Daemon closed the connection")
+    reply = json.loads(line)
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+    return reply['ok']
+
+
+async def run_daemon(tablets, servers, *, interval=0, reload=None, layout_poll=0, handlers=None,
+                     metrics=None, top=None):
+    """Serve tablets while publishing their frames
+
+    Args:
+        tablets (list): Tablet instances whose sinks are Routers
+        servers (list): FrameServers and ControlServers to start
+        interval (float): seconds between stats reports (0 disables them)
+        reload (function, optional): called on SIGHUP
+        layout_poll (float): seconds between monitor layout checks
+        handlers (dict, optional): more signal handlers by signal name
+        metrics (MetricsExporter, optional): serves the stats of `tablets`
+        top (TopView, optional): shown while the tablets run
+    """
+    for server in servers:
+        await server.start()
+    try:
+        await run(
+            tablets,
+            interval=interval, reload=reload, layout_poll=layout_poll, handlers=handlers,
+            metrics=metrics, top=top,
+        )
+    finally:
+        for server in servers:
+            server.close()
+
+
+async def read_hello(reader):
+    """Read the hello record from a FrameServer
+
+    Returns:
+        (reMarkable): settings of the tablet being published
+    """
+    tag, model = hello.unpack(await reader.readexactly(hello.size))
+    if tag != magic:
+        raise ValueError("Not a remouse frame socket")
+    return models[model.rstrip(b'\0').decode()]()
+
+
+class SubscriberTablet:
+    """Feed an output backend from a running daemon instead of the tablet
+
+    Same interface as Tablet.
+
+    Args:
+        path (str): socket of the daemon
+        make_sink (function): takes a reMarkable and returns an output backend
+            with a send(frame) method
+        stats (Stats): session counters
+    """
+
+    def __init__(self, path, make_sink, *, stats):
+        self.path = path
+        self.make_sink = make_sink
+        self.stats = stats
+        self.sink = None
+
+    async def run(self):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError as e:
+            log.error(f"No daemon on {self.path}: {e}")
+            return
+        try:
+            try:
+                rm = await read_hello(reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                log.error(f"No daemon on {self.path}")
+                return
+            log.info(f"Subscribed to {self.path}")
+            self.sink = self.make_sink(rm)
+            frame = PenFrame()
+            size = frame.record.size
+            while True:
+                try:
+                    data = await reader.readexactly(size)
+                except asyncio.IncompleteReadError:
+                    log.info("Daemon closed the connection")
+                    return
+                frame.unpack_from(data)
+                self.stats.frames += 1
+                self.sink.send(frame)
+        finally:
+            writer.close()
+
+
+def subscribe(path):
+    """Iterate over frames published by a daemon, for use in scripts
+
+    Args:
+        path (str): socket of the daemon
+
+    Yields:
+        PenFrame, updated in place
+    """
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        f = sock.makefile('rb')
+        tag, _ = hello.unpack(f.read(hello.size))
+        if tag != magic:
+            raise ValueError("Not a remouse frame socket")
+        frame = PenFrame()
+        size = frame.record.size
+        while True:
+            data = f.read(size)
+            if len(data) < size:
+                return
+            frame.unpack_from(data)
+            yield frame
@@ -1,14 +1,12 @@
 import logging
-import struct
-import subprocess
-from screeninfo import get_monitors
-import time
-from itertools import cycle
-from socket import timeout as TimeoutError
 import libevdev
 
-from .codes import codes, types
-from .common import get_monitor, log_event
+from .common import Mapping, get_monitor
+from .core import read_tablet as pipe_tablet
+from .curves import contact_table, linear, pressure_table, tilt_table
+from .frames import EV_ABS, EV_KEY, TOUCH, abs_fields, button_bits
+from .touch import ABS_MT_SLOT, POSITION_X, POSITION_Y, mt_fields
+from .trace import traced
 
 logging.basicConfig(format='%(message)s')
 log = logging.getLogger('remouse')
@@ -40,6 +38,9 @@ def create_local_device(rm):
     device.enable(libevdev.EV_KEY.BTN_TOUCH)
     device.enable(libevdev.EV_KEY.BTN_STYLUS)
     device.enable(libevdev.EV_KEY.BTN_STYLUS2)
+    # only sent when event rules map a pen button to them
+    device.enable(libevdev.EV_KEY.BTN_RIGHT)
+    device.enable(libevdev.EV_KEY.BTN_MIDDLE)
     device.enable(libevdev.EV_KEY.BTN_0)
     device.enable(libevdev.EV_KEY.BTN_1)
     device.enable(libevdev.EV_KEY.BTN_2)
@@ -76,77 +77,205 @@ def create_local_device(rm):
     return device.create_uinput_device()
 
 
-def read_tablet(rm, *, orientation, monitor_num, region, threshold, mode):
-    """Pipe rM evdev events to local device
+class EvdevSink:
+    """Replay pen frames on a local virtual tablet
 
     Args:
-        rm (reMarkable): tablet settings and input streams
+        rm (reMarkable): tablet settings
         orientation (str): tablet orientation
         monitor_num (int): monitor number to map to
-        threshold (int): pressure threshold
+        region (boolean): whether to selection mapping region with region tool
+        threshold (int): raw pressure needed for contact (0 to use the
+            tablet's own contact detection)
         mode (str): mapping mode
+        pressure_curve (function, optional): pressure response, see curves
+        tilt_curve (function, optional): tilt response, see curves
     """
 
-    local_device = create_local_device(rm)
-    log.debug("Created virtual input device '{}'".format(local_device.devnode))
+    # set by trace_sink when tracing
+    track = None
+
+    def __init__(self, rm, *, orientation, monitor_num, region, threshold, mode,
+                 pressure_curve=linear, tilt_curve=linear):
+        self.rm = rm
+        self.pressure_curve = pressure_curve
+        # tilt tables don't depend on any reloadable setting
+        self.tilt_x = tilt_table(tilt_curve, rm.pen_tilt_x)
+        self.tilt_y = tilt_table(tilt_curve, rm.pen_tilt_y)
+
+        self.local_device = create_local_device(rm)
+        log.debug("Created virtual input device '{}'".format(self.local_device.devnode))
 
-    monitor, (tot_width, tot_height) = get_monitor(region, monitor_num, orientation)
+        self.configure(
+            orientation=orientation,
+            monitor_num=monitor_num,
+            region=region,
+            threshold=threshold,
+            mode=mode,
+        )
 
-    pending_events = []
+        # events are created once and only their values change, so a frame
+        # allocates nothing that outlives it.  A batch needs one set per
+        # frame, since each event holds one value until the batch is sent
+        self.frame_events = []
+        self.syn = libevdev.InputEvent(libevdev.EV_SYN.SYN_REPORT, value=0)
+        self.events = []
 
-    x = y = 0
+        # one set of multitouch events per slot, since a report may carry
+        # several contacts: ABS_MT_SLOT followed by one event per axis
+        self.mt_events = [
+            [libevdev.InputEvent(libevdev.evbit(EV_ABS, ABS_MT_SLOT), value=slot)] + [
+                libevdev.InputEvent(libevdev.evbit(EV_ABS, e_code), value=0)
+                for e_code in mt_fields
+            ]
+            for slot in range(rm.touch_slot.max + 1)
+        ]
+        # axes other than position, which is mapped
+        self.mt_plain = [
+            axis for axis in mt_fields.values() if axis not in (POSITION_X, POSITION_Y)
+        ]
+        self.touch_events = []
 
-    stream = rm.pen
-    while True:
-        try:
-            # read evdev events from file stream
-            data = stream.read(struct.calcsize(rm.e_format))
-        except TimeoutError:
-            continue
+        # values of the abs events for the current and last frame
+        self.values = [0] * len(abs_fields)
+        # state last sent to the virtual device, None forces a full update
+        self.last = [None] * len(abs_fields)
+        self.last_buttons = None
 
-        # parse evdev events
-        e_time, e_millis, e_type, e_code, e_value = struct.unpack(rm.e_format, data)
+    def configure(self, *, orientation, monitor_num, region, threshold, mode):
+        """Recompute the mapping without touching the input stream or device"""
+        rm = self.rm
+        monitor, (tot_width, tot_height) = get_monitor(region, monitor_num, orientation)
+        # map to screen coordinates so that region/monitor/orientation options
+        # are applied, then back to wacom coordinates to reinsert into events
+        self.mapping = Mapping(rm, monitor, mode, orientation).scale(
+            rm.pen_x.max / tot_width, rm.pen_y.max / tot_height
+        )
+        self.touch_mapping = Mapping(rm, monitor, mode, orientation, touch=True).scale(
+            rm.touch_x.max / tot_width, rm.touch_y.max / tot_height
+        )
+        if self.track is not None:
+            self.mapping = traced(self.mapping, self.track, 'remap')
+        # curves and threshold are applied by indexing these tables with the
+        # raw value, instead of computing them for every event
+        self.pressure = pressure_table(self.pressure_curve, rm.pen_pressure, threshold)
+        self.contact = contact_table(rm.pen_pressure, threshold, TOUCH) if threshold > 0 else None
 
-        if log.level == logging.DEBUG:
-            log_event(e_time, e_millis, e_type, e_code, e_value)
+    def event_set(self, i):
+        """Preallocated (abs_events, key_events) for frame `i` of a batch"""
+        while len(self.frame_events) <= i:
+            self.frame_events.append((
+                [
+                    libevdev.InputEvent(libevdev.evbit(EV_ABS, e_code), value=0)
+                    for e_code in abs_fields
+                ],
+                [
+                    (bit, libevdev.InputEvent(libevdev.evbit(EV_KEY, e_code), value=0))
+                    for e_code, bit in button_bits.items()
+                ],
+            ))
+        return self.frame_events[i]
 
-        try:
-            # intercept EV_ABS events and modify coordinates
-            if types[e_type] == 'EV_ABS':
-                # handle x direction
-                if codes[e_type][e_code] == 'ABS_X':
-                    x = e_value
+    def send(self, frame):
+        events = self.events
+        events.clear()
+        self.add_events(frame, 0)
+        self.local_device.send_events(events)
 
-                # handle y direction
-                if codes[e_type][e_code] == 'ABS_Y':
-                    y = e_value
+    def send_batch(self, frames):
+        """Replay several frames with one call into libevdev"""
+        events = self.events
+        events.clear()
+        for i, frame in enumerate(frames):
+            self.add_events(frame, i)
+        self.local_device.send_events(events)
 
-                # map to screen coordinates so that region/monitor/orientation options are applied
-                mapped_x, mapped_y = rm.remap(
-                    x, y,
-                    rm.pen_x.max, rm.pen_y.max,
-                    monitor.width, monitor.height,
-                    mode, orientation
-                )
+    def add_events(self, frame, i):
+        """Append the events replaying `frame` to self.events, using event set `i`"""
+        rm = self.rm
+        abs_events, key_events = self.event_set(i)
+        mapped_x, mapped_y = self.mapping(frame.x, frame.y)
 
-                mapped_x += monitor.x
-                mapped_y += monitor.y
+        # the tables cover the declared range of each axis, values outside
+        # it (firmware variance) use the nearest entry
+        pressure = min(max(frame.pressure - rm.pen_pressure.min, 0), len(self.pressure) - 1)
+        buttons = frame.buttons
+        if self.contact is not None:
+            buttons = buttons & ~TOUCH | self.contact[pressure]
 
-                # map back to wacom coordinates to reinsert into event
-                mapped_x = mapped_x * rm.pen_x.max / tot_width
-                mapped_y = mapped_y * rm.pen_y.max / tot_height
+        # same order as abs_fields
+        values = self.values
+        values[0] = int(mapped_x)
+        values[1] = int(mapped_y)
+        values[2] = self.pressure[pressure]
+        values[3] = frame.distance
+        values[4] = self.tilt_x[min(max(frame.tilt_x - rm.pen_tilt_x.min, 0), len(self.tilt_x) - 1)]
+        values[5] = self.tilt_y[min(max(frame.tilt_y - rm.pen_tilt_y.min, 0), len(self.tilt_y) - 1)]
 
-                # reinsert modified values into evdev event
-                if codes[e_type][e_code] == 'ABS_X':
-                    e_value = int(mapped_x)
-                if codes[e_type][e_code] == 'ABS_Y':
-                    e_value = int(mapped_y)
+        # only send what changed since the last frame
+        last = self.last
+        events = self.events
+        for j, event in enumerate(abs_events):
+            if values[j] != last[j]:
+                event.value = last[j] = values[j]
+                events.append(event)
+        changed = ~0 if self.last_buttons is None else buttons ^ self.last_buttons
+        for bit, event in key_events:
+            if changed & bit:
+                event.value = 1 if buttons & bit else 0
+                events.append(event)
+        events.append(self.syn)
+        self.last_buttons = buttons
 
-        except KeyError as e:
-            log.debug(f"Invalid evdev event: type:{e_type} code:{e_code}")
+    def send_touch(self, tracker):
+        """Replay the changed slots of a TouchTracker"""
+        values = tracker.values
+        xs, ys = values[POSITION_X], values[POSITION_Y]
+        events = self.touch_events
+        events.clear()
+        for slot in tracker.dirty:
+            changed = tracker.changed[slot]
+            slot_events = self.mt_events[slot]
+            events.append(slot_events[0])
+            for axis in self.mt_plain:
+                if changed & 1 << axis:
+                    event = slot_events[axis + 1]
+                    event.value = values[axis][slot]
+                    events.append(event)
+            # rotation mixes the axes, so both are resent when either moves
+            if changed & (1 << POSITION_X | 1 << POSITION_Y):
+                mapped_x, mapped_y = self.touch_mapping(xs[slot], ys[slot])
+                event_x = slot_events[POSITION_X + 1]
+                event_y = slot_events[POSITION_Y + 1]
+                event_x.value = int(mapped_x)
+                event_y.value = int(mapped_y)
+                events.append(event_x)
+                events.append(event_y)
+        events.append(self.syn)
+        tracker.clear()
+        self.local_device.send_events(events)
 
-        # pass events directly to libevdev
-        e_bit = libevdev.evbit(e_type, e_code)
-        e = libevdev.InputEvent(e_bit, value=e_value)
-        local_device.send_events([e])
 
+def read_tablet(rm, *, orientation, monitor_num, region, threshold, mode,
+                stats=None, watchdog=None):
+    """Pipe rM evdev events to local device
+
+    Args:
+        rm (reMarkable): tablet settings and input streams
+        orientation (str): tablet orientation
+        monitor_num (int): monitor number to map to
+        threshold (int): pressure threshold
+        mode (str): mapping mode
+        stats (Stats, optional): session counters
+        watchdog (Watchdog, optional): stall detector, raises StallError
+    """
+
+    sink = EvdevSink(
+        rm,
+        orientation=orientation,
+        monitor_num=monitor_num,
+        region=region,
+        threshold=threshold,
+        mode=mode,
+    )
+    pipe_tablet(rm, sink, stats=stats, watchdog=watchdog)
@@ -0,0 +1,265 @@
+import logging
+import math
+import operator
+
+from .frames import TOOL_PEN, TOOL_RUBBER, TOUCH, PenFrame, Stage
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+
+def smoothing_factor(cutoff, dt):
+    """Exponential smoothing factor of a low pass filter at `cutoff` Hz"""
+    tau = 1 / (2 * math.pi * cutoff)
+    return 1 / (1 + tau / dt)
+
+
+class JitterFilter(Stage):
+    """Smooth the pen position and drop frames that only carry sensor noise
+
+    Position goes through a One Euro filter (Casiez et al., CHI 2012): its
+    cutoff frequency rises with pen speed, so a resting pen is smoothed
+    heavily while fast strokes pass through nearly unchanged.  Frames whose
+    filtered position moved less than `deadband` and which change nothing
+    else the output uses are then dropped.  Runs before the sink's remap.
+
+    Args:
+        sink: output backend or next stage, with a send(frame) method
+            and optionally a send_batch(frames) method
+        min_cutoff (float): cutoff frequency in Hz of a resting pen (0
+            disables smoothing)
+        beta (float): cutoff increase in Hz per tablet unit/s of pen speed
+        deadband (float): minimum movement in tablet units, frames moving
+            less than one unit are always dropped
+        stats (Stats, optional): counts frames dropped as 'filtered'
+    """
+
+    # cutoff in Hz for the speed estimate
+    d_cutoff = 1.0
+
+    def __init__(self, sink, *, min_cutoff=1.0, beta=0.002, deadband=0, stats=None):
+        super().__init__(sink)
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.deadband = deadband
+        self.stats = stats
+        # fields besides position which make a frame worth sending
+        others = [f for f in self.fields if f not in ('x', 'y')]
+        self.others = operator.attrgetter(*others) if others else lambda frame: None
+
+        self.out = PenFrame()
+        self.reset()
+
+    def reset(self):
+        # filter state, None until the first frame
+        self.time = None
+        self.x = self.y = 0.
+        self.dx = self.dy = 0.
+        # what was last sent
+        self.sent_x = self.sent_y = 0
+        self.sent_buttons = None
+        self.sent_others = None
+
+    def smooth(self, frame):
+        """Update the filter with the position in `frame`"""
+        if self.time is None or self.min_cutoff <= 0:
+            self.x, self.y = frame.x, frame.y
+            self.time = frame.time
+            return
+        dt = frame.time - self.time
+        if dt <= 0:
+            dt = 1e-3
+        self.time = frame.time
+
+        a = smoothing_factor(self.d_cutoff, dt)
+        self.dx += a * ((frame.x - self.x) / dt - self.dx)
+        self.dy += a * ((frame.y - self.y) / dt - self.dy)
+
+        cutoff = self.min_cutoff + self.beta * math.hypot(self.dx, self.dy)
+        a = smoothing_factor(cutoff, dt)
+        self.x += a * (frame.x - self.x)
+        self.y += a * (frame.y - self.y)
+
+    def filter(self, frame):
+        """Update the filter with `frame`
+
+        Returns:
+            (int, int): position to send, or None to drop the frame
+        """
+        self.smooth(frame)
+        if not frame.buttons & (TOOL_PEN | TOOL_RUBBER):
+            # the pen may come back anywhere, don't smooth towards it
+            self.time = None
+
+        x, y = round(self.x), round(self.y)
+        others = self.others(frame)
+        # a frame which wouldn't move the output by a whole unit is noise too
+        deadband = max(self.deadband, 1)
+        if (
+            frame.buttons == self.sent_buttons
+            and others == self.sent_others
+            and abs(x - self.sent_x) < deadband
+            and abs(y - self.sent_y) < deadband
+        ):
+            if self.stats is not None:
+                self.stats.filtered += 1
+            return None
+
+        self.sent_x, self.sent_y = x, y
+        self.sent_buttons = frame.buttons
+        self.sent_others = others
+        return x, y
+
+    def send(self, frame):
+        position = self.filter(frame)
+        if position is None:
+            return
+        # the assembler's frame must keep the raw values, so send a copy
+        out = self.out
+        out.copy_from(frame)
+        out.x, out.y = position
+        self.sink.send(out)
+
+    def send_batch(self, frames):
+        # batches are copies this stage may change, dropped frames are
+        # removed by moving the kept ones forward
+        kept = 0
+        for frame in frames:
+            position = self.filter(frame)
+            if position is not None:
+                frame.x, frame.y = position
+                frames[kept] = frame
+                kept += 1
+        del frames[kept:]
+        if frames:
+            self.send_next(frames)
+
+
+class Predictor(Stage):
+    """Extrapolate the pen position forward to hide transport latency
+
+    Velocity (and optionally acceleration) is estimated from consecutive
+    frames and the position is pushed `lead` seconds ahead.  Prediction is
+    off around contact changes and while the pen is out of range, where the
+    motion model doesn't hold.
+
+    Args:
+        sink: output backend or next stage, with a send(frame) method
+            and optionally a send_batch(frames) method
+        lead (float): seconds to predict ahead, about the one way latency
+        model (str): 'velocity' or 'acceleration'
+        smoothing (float): weight of the newest sample in the estimates (0-1]
+        settle (int): frames after a contact change which are sent unchanged
+    """
+
+    def __init__(self, sink, *, lead, model='velocity', smoothing=0.5, settle=3):
+        super().__init__(sink)
+        self.lead = lead
+        self.acceleration = model == 'acceleration'
+        self.smoothing = smoothing
+        self.settle = settle
+        self.out = PenFrame()
+        self.time = None
+        self.x = self.y = 0
+        self.vx = self.vy = 0.
+        self.ax = self.ay = 0.
+        self.contact = 0
+        self.wait = 0
+
+    def predict(self, frame):
+        """Update the motion estimate with `frame`
+
+        Returns:
+            (float, float): predicted position
+        """
+        contact = frame.buttons & TOUCH
+        in_range = frame.buttons & (TOOL_PEN | TOOL_RUBBER)
+        if self.time is None or contact != self.contact or not in_range:
+            self.vx = self.vy = self.ax = self.ay = 0.
+            self.wait = self.settle
+        elif frame.time > self.time:
+            s = self.smoothing
+            dt = frame.time - self.time
+            vx = (frame.x - self.x) / dt
+            vy = (frame.y - self.y) / dt
+            if self.acceleration:
+                self.ax += s * ((vx - self.vx) / dt - self.ax)
+                self.ay += s * ((vy - self.vy) / dt - self.ay)
+            self.vx += s * (vx - self.vx)
+            self.vy += s * (vy - self.vy)
+        self.time = frame.time
+        self.x, self.y = frame.x, frame.y
+        self.contact = contact
+
+        if self.wait:
+            self.wait -= 1
+            return frame.x, frame.y
+        lead = self.lead
+        return (
+            frame.x + self.vx * lead + self.ax * lead * lead / 2,
+            frame.y + self.vy * lead + self.ay * lead * lead / 2,
+        )
+
+    def send(self, frame):
+        x, y = self.predict(frame)
+        out = self.out
+        out.copy_from(frame)
+        out.x, out.y = round(x), round(y)
+        self.sink.send(out)
+
+    def send_batch(self, frames):
+        for frame in frames:
+            x, y = self.predict(frame)
+            frame.x, frame.y = round(x), round(y)
+        self.send_next(frames)
+
+
+class Recorder(Stage):
+    """Save every frame to a file, e.g. for `python -m remarkable_mouse.bench predict`
+
+    The file is a sequence of PenFrame.record structs.
+
+    Args:
+        sink: output backend or next stage, with a send(frame) method
+            and optionally a send_batch(frames) method
+        path (str): file to write
+    """
+
+    def __init__(self, sink, path):
+        super().__init__(sink)
+        self.file = open(path, 'wb')
+        self.buf = bytearray(PenFrame.record.size)
+
+    def send(self, frame):
+        frame.pack_into(self.buf, 0)
+        self.file.write(memoryview(self.buf)[:PenFrame.record.size])
+        self.sink.send(frame)
+
+    def send_batch(self, frames):
+        size = PenFrame.record.size
+        if len(self.buf) < len(frames) * size:
+            self.buf = bytearray(len(frames) * size)
+        for i, frame in enumerate(frames):
+            frame.pack_into(self.buf, i * size)
+        self.file.write(memoryview(self.buf)[:len(frames) * size])
+        self.send_next(frames)
+
+    def close(self):
+        self.file.close()
+
+
+def load_recording(path):
+    """Read frames saved by a Recorder
+
+    Returns:
+        list of PenFrame
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    frames = []
+    size = PenFrame.record.size
+    for offset in range(0, len(data) - size + 1, size):
+        frame = PenFrame()
+        frame.unpack_from(data, offset)
+        frames.append(frame)
+    return frames
@@ -0,0 +1,299 @@
+import logging
+import operator
+import struct
+
+from .codes import codes
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+
+def code(name):
+    """Look up the (type, code) pair of an evdev code name, e.g. 'ABS_X'"""
+    for e_type, names in codes.items():
+        for e_code, code_name in names.items():
+            if code_name == name:
+                return e_type, e_code
+    raise KeyError(name)
+
+EV_SYN, SYN_REPORT = code('SYN_REPORT')
+_, SYN_DROPPED = code('SYN_DROPPED')
+EV_KEY, BTN_TOOL_PEN = code('BTN_TOOL_PEN')
+_, BTN_TOOL_RUBBER = code('BTN_TOOL_RUBBER')
+_, BTN_TOUCH = code('BTN_TOUCH')
+_, BTN_STYLUS = code('BTN_STYLUS')
+_, BTN_STYLUS2 = code('BTN_STYLUS2')
+_, BTN_RIGHT = code('BTN_RIGHT')
+_, BTN_MIDDLE = code('BTN_MIDDLE')
+EV_ABS, ABS_X = code('ABS_X')
+_, ABS_Y = code('ABS_Y')
+_, ABS_PRESSURE = code('ABS_PRESSURE')
+_, ABS_DISTANCE = code('ABS_DISTANCE')
+_, ABS_TILT_X = code('ABS_TILT_X')
+_, ABS_TILT_Y = code('ABS_TILT_Y')
+
+# bits of PenFrame.buttons
+TOOL_PEN = 1 << 0
+TOOL_RUBBER = 1 << 1
+TOUCH = 1 << 2
+STYLUS = 1 << 3
+STYLUS2 = 1 << 4
+# mouse buttons, only set by event rules
+RIGHT = 1 << 5
+MIDDLE = 1 << 6
+
+# button bit for each EV_KEY code
+button_bits = {
+    BTN_TOOL_PEN: TOOL_PEN,
+    BTN_TOOL_RUBBER: TOOL_RUBBER,
+    BTN_TOUCH: TOUCH,
+    BTN_STYLUS: STYLUS,
+    BTN_STYLUS2: STYLUS2,
+    BTN_RIGHT: RIGHT,
+    BTN_MIDDLE: MIDDLE,
+}
+
+# PenFrame attribute for each EV_ABS code
+abs_fields = {
+    ABS_X: 'x',
+    ABS_Y: 'y',
+    ABS_PRESSURE: 'pressure',
+    ABS_DISTANCE: 'distance',
+    ABS_TILT_X: 'tilt_x',
+    ABS_TILT_Y: 'tilt_y',
+}
+
+
+class PenFrame:
+    """Complete pen state as of one SYN_REPORT
+
+    Attributes:
+        time (float): tablet timestamp in seconds
+        x, y (int): position in tablet coordinates
+        pressure, distance, tilt_x, tilt_y (int): raw axis values
+        buttons (int): bitmask of TOOL_PEN, TOOL_RUBBER, TOUCH, STYLUS, STYLUS2,
+            RIGHT, MIDDLE
+    """
+
+    __slots__ = ('time', 'x', 'y', 'pressure', 'distance', 'tilt_x', 'tilt_y', 'buttons')
+
+    # fixed size binary record used when frames cross process boundaries
+    record = struct.Struct('<d6iI')
+
+    def __init__(self):
+        self.time = 0.
+        self.x = self.y = 0
+        self.pressure = self.distance = 0
+        self.tilt_x = self.tilt_y = 0
+        self.buttons = 0
+
+    def __repr__(self):
+        return 'PenFrame({})'.format(', '.join(
+            f'{name}={getattr(self, name)}' for name in self.__slots__
+        ))
+
+    def copy_from(self, other):
+        """Overwrite this frame with the contents of `other`"""
+        self.time = other.time
+        self.x, self.y = other.x, other.y
+        self.pressure, self.distance = other.pressure, other.distance
+        self.tilt_x, self.tilt_y = other.tilt_x, other.tilt_y
+        self.buttons = other.buttons
+
+    def pack_into(self, buf, offset=0):
+        self.record.pack_into(
+            buf, offset, self.time, self.x, self.y, self.pressure,
+            self.distance, self.tilt_x, self.tilt_y, self.buttons
+        )
+
+    def unpack_from(self, buf, offset=0):
+        (
+            self.time, self.x, self.y, self.pressure, self.distance,
+            self.tilt_x, self.tilt_y, self.buttons
+        ) = self.record.unpack_from(buf, offset)
+
+
+class HoverPolicy:
+    """Decide which frames to deliver while the pen isn't touching
+
+    Frames where the pen touches or a button changes are always delivered.
+    Otherwise a frame is dropped if the pen is out of range, if none of the
+    fields the output uses changed, or if it comes sooner than `rate` allows.
+
+    Args:
+        rate (float): maximum hover frames per second (0 for no limit)
+        fields (tuple): PenFrame attributes used by the output
+        stats (Stats, optional): counts suppressed frames
+    """
+
+    def __init__(self, rate=0, fields=tuple(abs_fields.values()), stats=None):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.values = operator.attrgetter(*fields)
+        self.stats = stats
+        # used values, buttons and time of the last delivered frame
+        self.last = None
+        self.last_buttons = None
+        self.last_time = 0.
+
+    def accept(self, frame):
+        """
+        Returns:
+            bool: whether `frame` should be delivered
+        """
+        buttons = frame.buttons
+        values = self.values(frame)
+        if buttons & TOUCH or buttons != self.last_buttons:
+            pass
+        elif (
+            not buttons & (TOOL_PEN | TOOL_RUBBER)
+            or values == self.last
+            or frame.time - self.last_time < self.interval
+        ):
+            if self.stats is not None:
+                self.stats.suppressed += 1
+            return False
+        self.last = values
+        self.last_buttons = buttons
+        self.last_time = frame.time
+        return True
+
+
+class FrameAssembler:
+    """Accumulate pen evdev events into PenFrames
+
+    `frame` always holds the latest complete state and is updated in place,
+    so consumers must copy it if they need to keep it past the next frame.
+
+    Args:
+        hover (HoverPolicy, optional): filter for frames without contact
+        rules (EventRules, optional): compiled event rules
+    """
+
+    def __init__(self, hover=None, rules=None):
+        self.frame = PenFrame()
+        self.dropped = False
+        self.hover = hover
+        # dispatch tables, see EventRules
+        self.abs_fields = abs_fields if rules is None else rules.abs_fields
+        self.button_bits = button_bits if rules is None else rules.button_bits
+        self.clamp = {} if rules is None else rules.clamp
+
+    def feed(self, e_time, e_usec, e_type, e_code, e_value):
+        """Apply one event
+
+        Returns:
+            bool: True if the event completed a frame
+        """
+        frame = self.frame
+        if e_type == EV_ABS:
+            field = self.abs_fields.get(e_code)
+            if field is not None:
+                setattr(frame, field, e_value)
+            else:
+                clamp = self.clamp.get(e_code)
+                if clamp is not None:
+                    field, low, high = clamp
+                    setattr(frame, field, min(max(e_value, low), high))
+        elif e_type == EV_KEY:
+            bit = self.button_bits.get(e_code)
+            if bit is not None:
+                if e_value:
+                    frame.buttons |= bit
+                else:
+                    frame.buttons &= ~bit
+        elif e_type == EV_SYN:
+            if e_code == SYN_REPORT:
+                frame.time = e_time + e_usec / 1e6
+                # events after SYN_DROPPED are incomplete until the next report
+                if self.dropped:
+                    self.dropped = False
+                    return False
+                return self.hover is None or self.hover.accept(frame)
+            elif e_code == SYN_DROPPED:
+                log.debug("Tablet dropped events")
+                self.dropped = True
+        return False
+
+
+class FrameBatch:
+    """Frames delivered to a pipeline stage in one call
+
+    Stages take batches through a send_batch(frames) method, so each stage
+    costs one call per read from the tablet rather than one per frame.
+    `frames` holds copies from a pool which is reused by the next batch,
+    so consumers must copy frames they need to keep.  Unlike a single
+    frame, a batch belongs to the stage it's passed to, which may change
+    the frames or the list in place instead of copying them.
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.pool = []
+
+    def clear(self):
+        self.frames.clear()
+
+    def add(self, frame):
+        """Append a copy of `frame`
+
+        Returns:
+            PenFrame: the copy, which may still be modified
+        """
+        n = len(self.frames)
+        if n == len(self.pool):
+            self.pool.append(PenFrame())
+        out = self.pool[n]
+        out.copy_from(frame)
+        self.frames.append(out)
+        return out
+
+
+def batched(stage):
+    """Batch method of a pipeline stage
+
+    Returns:
+        function: stage.send_batch, or a loop calling stage.send with each
+            frame for stages which only take single frames
+    """
+    send_batch = getattr(stage, 'send_batch', None)
+    if send_batch is not None:
+        return send_batch
+    send = stage.send
+
+    def send_each(frames):
+        for frame in frames:
+            send(frame)
+    return send_each
+
+
+class Stage:
+    """Base of pipeline stages which wrap an output backend or next stage
+
+    Subclasses implement send(frame) and optionally send_batch(frames),
+    passing frames on with self.sink.send and self.send_next.  Everything
+    else goes straight to the wrapped output.
+
+    Args:
+        sink: output backend or next stage, with a send(frame) method
+            and optionally a send_batch(frames) method, or None until the
+            subclass binds one
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.send_next = None if sink is None else batched(sink)
+
+    @property
+    def fields(self):
+        """PenFrame attributes used by the wrapped output"""
+        return getattr(self.sink, 'fields', tuple(abs_fields.values()))
+
+    @property
+    def send_touch(self):
+        """Touch goes straight to the wrapped output, if it takes it"""
+        return getattr(self.sink, 'send_touch', None)
+
+    def configure(self, **settings):
+        """Recompute the mapping of the wrapped output"""
+        if self.sink is not None:
+            self.sink.configure(**settings)
@@ -0,0 +1,133 @@
+import logging
+import math
+import time
+from array import array
+
+from .touch import POSITION_X, POSITION_Y, TRACKING_ID
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+
+class Trackpad:
+    """Turn touchscreen reports into pointer motion, scrolling and zooming
+
+    One finger moves the pointer, two fingers scroll, and two fingers
+    moving apart or together zoom.  The finger count, centroid and spread
+    are kept as running sums which are only updated for the slots that
+    changed, so a report costs the same however many fingers are down.
+    Scroll and zoom deltas are accumulated and sent at most once per
+    `interval`.
+
+    Args:
+        slots (int): number of touch slots
+        move (function): called with (dx, dy) in pixels to move the pointer
+        scroll (function): called with (dx, dy) in scroll steps
+        zoom (function): called with a number of zoom steps, positive to
+            zoom in
+        interval (float): minimum seconds between scroll or zoom events
+        step (float): pixels of finger travel per scroll step
+        pinch (float): relative change in finger spread per zoom step
+    """
+
+    def __init__(self, slots, *, move, scroll, zoom, interval=1 / 60, step=40, pinch=0.15):
+        self.move = move
+        self.scroll = scroll
+        self.zoom = zoom
+        self.interval = interval
+        self.step = step
+        self.pinch = math.log1p(pinch)
+
+        # raw position each slot contributes to the sums below
+        self.active = bytearray(slots)
+        self.px = array('d', [0.] * slots)
+        self.py = array('d', [0.] * slots)
+        self.fingers = 0
+        self.sum_x = self.sum_y = 0.
+        self.sum_sq = 0.
+
+        # gesture state, reset whenever the number of fingers changes
+        self.count = 0
+        self.x = self.y = 0.
+        self.spread = 0.
+        self.pending_x = self.pending_y = 0.
+        self.last_emit = 0.
+
+    def update(self, tracker, mapping):
+        """Apply the changed slots of a TouchTracker
+
+        Args:
+            tracker (TouchTracker): touch state, cleared afterwards
+            mapping (Mapping): touchscreen to screen transform
+        """
+        values = tracker.values
+        ids, xs, ys = values[TRACKING_ID], values[POSITION_X], values[POSITION_Y]
+        for slot in tracker.dirty:
+            if self.active[slot]:
+                x, y = self.px[slot], self.py[slot]
+                self.fingers -= 1
+                self.sum_x -= x
+                self.sum_y -= y
+                self.sum_sq -= x * x + y * y
+            if ids[slot] >= 0:
+                x, y = xs[slot], ys[slot]
+                self.px[slot], self.py[slot] = x, y
+                self.active[slot] = 1
+                self.fingers += 1
+                self.sum_x += x
+                self.sum_y += y
+                self.sum_sq += x * x + y * y
+            else:
+                self.active[slot] = 0
+        tracker.clear()
+
+        n = self.fingers
+        if n == 0:
+            self.count = 0
+            return
+        mean_x, mean_y = self.sum_x / n, self.sum_y / n
+        x, y = mapping(mean_x, mean_y)
+        # root mean square distance of the fingers from their centroid
+        spread = math.sqrt(max(self.sum_sq / n - mean_x * mean_x - mean_y * mean_y, 0))
+
+        if n != self.count:
+            # start over from here, so adding or lifting a finger doesn't jump
+            self.count = n
+            self.x, self.y = x, y
+            self.spread = spread
+            self.pending_x = self.pending_y = 0.
+            return
+
+        dx, dy = x - self.x, y - self.y
+        self.x, self.y = x, y
+        if n == 1:
+            self.move(dx, dy)
+            return
+        if n != 2:
+            return
+
+        now = time.monotonic()
+        if now - self.last_emit < self.interval:
+            self.pending_x += dx
+            self.pending_y += dy
+            return
+
+        if self.spread > 0 and spread > 0:
+            steps = int(math.log(spread / self.spread) / self.pinch)
+            if steps:
+                self.zoom(steps)
+                self.spread = spread
+                self.pending_x = self.pending_y = 0.
+                self.last_emit = now
+                return
+
+        # fingers moving down scroll up, like dragging the page
+        self.pending_x += dx
+        self.pending_y += dy
+        steps_x = int(self.pending_x / self.step)
+        steps_y = int(self.pending_y / self.step)
+        if steps_x or steps_y:
+            self.scroll(-steps_x, steps_y)
+            self.pending_x -= steps_x * self.step
+            self.pending_y -= steps_y * self.step
+            self.last_emit = now
@@ -0,0 +1,188 @@
+import asyncio
+import http.server
+import logging
+import os
+import socketserver
+import threading
+
+from .stats import Histogram
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+# counter name and help for each Stats counter, stream counters get a label
+counter_help = {
+    'bytes': ('remouse_bytes_total', "Bytes received from the pen stream"),
+    'reconnects': ('remouse_reconnects_total', "Reconnects after a stall"),
+    'stalls': ('remouse_stalls_total', "Stalls detected by the watchdog"),
+    'dropped': ('remouse_dropped_frames_total', "Frames lost by a lagging reader"),
+    'coalesced': ('remouse_coalesced_frames_total', "Frames merged for slow subscribers"),
+    'suppressed': ('remouse_suppressed_frames_total', "Hover frames dropped by the hover policy"),
+    'filtered': ('remouse_filtered_frames_total', "Frames dropped by the jitter filter"),
+}
+stream_counters = {
+    'events': ('remouse_events_total', "Input events read", 'pen'),
+    'touch_events': ('remouse_events_total', "Input events read", 'touch'),
+    'frames': ('remouse_frames_total', "Frames assembled", 'pen'),
+    'touch_frames': ('remouse_frames_total', "Frames assembled", 'touch'),
+}
+# settings reported as labels of remouse_tablet_info
+info_labels = ('model', 'mode', 'orientation', 'transport')
+
+
+class LatencyTrack:
+    """Track (see trace.Track) which puts span durations into histograms
+
+    Args:
+        stats (Stats): session counters, histograms go in stats.latency
+    """
+
+    def __init__(self, stats):
+        self.latency = stats.latency
+
+    def span(self, name, start, end, args=None):
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = Histogram()
+        histogram.observe(end - start)
+
+    def counter(self, name, t, values):
+        pass
+
+
+def render(tablets):
+    """Prometheus text exposition of the stats of every tablet
+
+    Returns:
+        str
+    """
+    lines = []
+
+    def family(name, kind, help):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    def labels(stats, **extra):
+        pairs = dict(tablet=stats.settings.get('address', ''), **extra)
+        return ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in pairs.items()
+        )
+
+    stats_list = [tablet.stats for tablet in tablets]
+
+    family('remouse_tablet_info', 'gauge', "Tablet model and mapping settings")
+    for stats in stats_list:
+        info = {k: stats.settings[k] for k in info_labels if k in stats.settings}
+        lines.append(f'remouse_tablet_info{{{labels(stats, **info)}}} 1')
+
+    family('remouse_uptime_seconds', 'gauge', "Seconds since start")
+    for stats in stats_list:
+        lines.append(f'remouse_uptime_seconds{{{labels(stats)}}} {stats.snapshot()["uptime"]:.3f}')
+
+    done = set()
+    for counter, (name, help, stream) in stream_counters.items():
+        if name not in done:
+            family(name, 'counter', help)
+            done.add(name)
+        for stats in stats_list:
+            lines.append(f'{name}{{{labels(stats, stream=stream)}}} {getattr(stats, counter)}')
+
+    for counter, (name, help) in counter_help.items():
+        family(name, 'counter', help)
+        for stats in stats_list:
+            lines.append(f'{name}{{{labels(stats)}}} {getattr(stats, counter)}')
+
+    family('remouse_backlog_bytes', 'gauge', "Bytes received over SSH but not read yet")
+    for stats in stats_list:
+        lines.append(f'remouse_backlog_bytes{{{labels(stats)}}} {stats.backlog}')
+
+    name = 'remouse_stage_seconds'
+    family(name, 'histogram', "Time spent in each pipeline stage")
+    for stats in stats_list:
+        for stage, histogram in list(stats.latency.items()):
+            total = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                total += count
+                lines.append(f'{name}_bucket{{{labels(stats, stage=stage, le=bound)}}} {total}')
+            lines.append(f'{name}_sum{{{labels(stats, stage=stage)}}} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{{{labels(stats, stage=stage)}}} {total}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        page = self.server.exporter.page
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsExporter:
+    """Serve Prometheus metrics of the running tablets
+
+    The event loop renders a new page every `interval` seconds and swaps
+    it in with a single assignment.  The HTTP server runs on a background
+    thread and only ever reads the latest page, so a scrape never waits on
+    the event loop and the loop never waits on a scrape.
+
+    Args:
+        address (str): 'port', 'host:port', or the path of a UNIX socket
+            (anything whose port isn't a number, or with a 'unix:' prefix)
+        tablets (list): Tablet instances whose stats are exported
+        interval (float): seconds between page updates
+    """
+
+    def __init__(self, address, tablets, interval=1):
+        self.address = address
+        host, _, port = address.rpartition(':')
+        if address.startswith('unix:'):
+            self.path = address[len('unix:'):]
+        elif port.isdigit():
+            self.path = None
+            self.host, self.port = host or '127.0.0.1', int(port)
+        else:
+            self.path = address
+        self.tablets = tablets
+        self.interval = interval
+        self.page = b''
+        self.server = None
+
+    def start(self):
+        """Listen on `address` and serve pages from a daemon thread"""
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = UnixServer(self.path, Handler)
+        else:
+            self.server = TCPServer((self.host, self.port), Handler)
+        self.server.exporter = self
+        self.page = render(self.tablets).encode()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f"Serving metrics on {self.address}")
+
+    async def publish(self):
+        """Render a new page every `interval` seconds, run on the event loop"""
+        while True:
+            await asyncio.sleep(self.interval)
+            self.page = render(self.tablets).encode()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.path is not None:
+            os.unlink(self.path)
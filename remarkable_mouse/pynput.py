@@ -1,10 +1,11 @@
 import logging
-import struct
-from screeninfo import get_monitors
+import sys
 
-# from .codes import EV_SYN, EV_ABS, ABS_X, ABS_Y, BTN_TOUCH
-from .codes import codes
-from .common import get_monitor, log_event
+from .common import Mapping, get_monitor
+from .core import read_tablet as pipe_tablet
+from .frames import MIDDLE, RIGHT, TOUCH
+from .gestures import Trackpad
+from .trace import traced
 
 logging.basicConfig(format='%(message)s')
 log = logging.getLogger('remouse')
@@ -14,7 +15,105 @@ log = logging.getLogger('remouse')
 # finger_width = 767
 # finger_height = 1023
 
-def read_tablet(rm, *, orientation, monitor_num, region, threshold, mode):
+class PynputSink:
+    """Map pen frames to the system mouse
+
+    Args:
+        rm (reMarkable): tablet settings
+        orientation (str): tablet orientation
+        monitor_num (int): monitor number to map to
+        region (boolean): whether to selection mapping region with region tool
+        threshold (int): pressure threshold
+        mode (str): mapping mode
+    """
+
+    # PenFrame attributes this backend uses, see HoverPolicy
+    fields = ('x', 'y')
+    # set by trace_sink when tracing
+    track = None
+
+    def __init__(self, rm, *, orientation, monitor_num, region, threshold, mode):
+        from pynput.keyboard import Controller as Keyboard, Key
+        from pynput.mouse import Button, Controller
+
+        self.rm = rm
+        self.mouse = Controller()
+        self.keyboard = Keyboard()
+        self.zoom_key = Key.cmd if sys.platform == 'darwin' else Key.ctrl
+        # frame button bits which click, RIGHT and MIDDLE come from event rules
+        self.buttons = ((TOUCH, Button.left), (RIGHT, Button.right), (MIDDLE, Button.middle))
+        self.clicks = TOUCH | RIGHT | MIDDLE
+        self.pressed = 0
+        self.trackpad = Trackpad(
+            rm.touch_slot.max + 1,
+            move=self.mouse.move,
+            scroll=self.mouse.scroll,
+            zoom=self.zoom,
+        )
+
+        self.configure(
+            orientation=orientation,
+            monitor_num=monitor_num,
+            region=region,
+            threshold=threshold,
+            mode=mode,
+        )
+
+    def configure(self, *, orientation, monitor_num, region, threshold, mode):
+        """Recompute the mapping without touching the input stream"""
+        monitor, _ = get_monitor(region, monitor_num, orientation)
+        log.debug('Chose monitor: {}'.format(monitor))
+        self.mapping = Mapping(self.rm, monitor, mode, orientation)
+        self.touch_mapping = Mapping(self.rm, monitor, mode, orientation, touch=True)
+        if self.track is not None:
+            self.mapping = traced(self.mapping, self.track, 'remap')
+
+    def send(self, frame):
+        mouse = self.mouse
+
+        mapped_x, mapped_y = self.mapping(frame.x, frame.y)
+        mouse.move(
+            mapped_x - mouse.position[0],
+            mapped_y - mouse.position[1]
+        )
+
+        # handle draw and clicks
+        pressed = frame.buttons & self.clicks
+        changed = pressed ^ self.pressed
+        if changed:
+            self.pressed = pressed
+            for bit, button in self.buttons:
+                if changed & bit:
+                    if pressed & bit:
+                        mouse.press(button)
+                    else:
+                        mouse.release(button)
+
+    def send_batch(self, frames):
+        # each move is a system call, so a hovering pen only moves to its
+        # latest position.  Every frame is sent while drawing, to keep the
+        # shape of strokes, and around clicks
+        last = len(frames) - 1
+        for i, frame in enumerate(frames):
+            if (
+                i == last
+                or self.pressed & TOUCH
+                or frame.buttons & self.clicks != self.pressed
+            ):
+                self.send(frame)
+
+    def send_touch(self, tracker):
+        """Use the touchscreen as a trackpad"""
+        self.trackpad.update(tracker, self.touch_mapping)
+
+    def zoom(self, steps):
+        # most applications zoom on ctrl+scroll (cmd+scroll on macOS)
+        with self.keyboard.pressed(self.zoom_key):
+            self.mouse.scroll(0, steps)
+
+
+def read_tablet(rm, *, orientation, monitor_num, region, threshold, mode,
+                stats=None, watchdog=None):
     """Loop forever and map evdev events to mouse
 
     Args:
@@ -24,57 +123,16 @@ def read_tablet(rm, *, orientation, monitor_num, region, threshold, mode):
         region (boolean): whether to selection mapping region with region tool
         threshold (int): pressure threshold
         mode (str): mapping mode
+        stats (Stats, optional): session counters
+        watchdog (Watchdog, optional): stall detector, raises StallError
     """
 
-    from pynput.mouse import Button, Controller
-
-    mouse = Controller()
-
-    monitor, _ = get_monitor(region, monitor_num, orientation)
-    log.debug('Chose monitor: {}'.format(monitor))
-
-    x = y = 0
-
-    stream = rm.pen
-    while True:
-        try:
-            # read evdev events from file stream
-            data = stream.read(struct.calcsize(rm.e_format))
-        except TimeoutError:
-            continue
-
-        # parse evdev events
-        e_time, e_millis, e_type, e_code, e_value = struct.unpack(rm.e_format, data)
-
-        if log.level == logging.DEBUG:
-            log_event(e_time, e_millis, e_type, e_code, e_value)
-
-        try:
-            # handle x direction
-            if codes[e_type][e_code] == 'ABS_X':
-                x = e_value
-
-            # handle y direction
-            if codes[e_type][e_code] == 'ABS_Y':
-                y = e_value
-
-            # handle draw
-            if codes[e_type][e_code] == 'BTN_TOUCH':
-                if e_value == 1:
-                    mouse.press(Button.left)
-                else:
-                    mouse.release(Button.left)
-
-            if codes[e_type][e_code] == 'SYN_REPORT':
-                mapped_x, mapped_y = rm.remap(
-                    x, y,
-                    rm.pen_x.max, rm.pen_y.max,
-                    monitor.width, monitor.height,
-                    mode, orientation,
-                )
-                mouse.move(
-                    monitor.x + mapped_x - mouse.position[0],
-                    monitor.y + mapped_y - mouse.position[1]
-                )
-        except KeyError as e:
-            log.debug(f"Invalid evdev event: type:{e_type} code:{e_code}")
+    sink = PynputSink(
+        rm,
+        orientation=orientation,
+        monitor_num=monitor_num,
+        region=region,
+        threshold=threshold,
+        mode=mode,
+    )
+    pipe_tablet(rm, sink, stats=stats, watchdog=watchdog)
@@ -2,38 +2,61 @@
 # Use reMarkable as mouse input
 
 import argparse
+import asyncio
+import configparser
+import functools
+import gc
 import logging
 import os
 import sys
-import struct
 from getpass import getpass
-from itertools import cycle
+from threading import Lock
 
 import paramiko
 import paramiko.agent
 import paramiko.config
 
-from .common import reMarkable1, reMarkable2, reMarkablePro
+from .common import get_region, reMarkable1, reMarkable2, reMarkablePro
+from .core import Tablet, run
+from .daemon import (
+    ControlServer, FrameServer, Router, SubscriberTablet, control,
+    control_socket, default_socket, run_daemon
+)
+from .curves import parse_curve
+from .filters import JitterFilter, Predictor, Recorder
+from .metrics import MetricsExporter
+from .ring import RingTablet
+from .rules import EventRules, load_rules
+from .state import StateWriter, default_state
+from .sampler import StackSampler, default_profile
+from .stats import Stats
+from .trace import Tracer
+from .transport import benchmark_transport, print_benchmark, profiles, transport_factory
 
 logging.basicConfig(format='%(message)s')
 log = logging.getLogger('remouse')
 
 default_key = os.path.expanduser('~/.ssh/remarkable')
 config_path = os.path.expanduser('~/.ssh/config')
+# seconds allowed for TCP connect, SSH banner and authentication
+connect_timeout = 10
+# tablets connect in parallel, but only one may prompt at a time
+prompt_lock = Lock()
 
 
-def connect_rm(*, address, key, password):
+def open_client(*, address, key, password, keepalive=0, transport='default'):
     """
-    Open a remote input device via SSH.
+    Open an authenticated SSH connection to the reMarkable.
 
     Args:
         address (str): address to reMarkable
         key (str, optional): path to reMarkable ssh key
         password (str, optional): reMarkable ssh password
+        keepalive (float, optional): seconds between SSH keepalive packets
+            (0 disables keepalives)
+        transport (str, optional): name of transport profile to use
     Returns:
-        (paramiko.ChannelFile): read-only stream of pen events
-        (paramiko.ChannelFile): read-only stream of touch events
-        (paramiko.ChannelFile): read-only stream of button events
+        (paramiko.SSHClient): connected client
     """
     log.debug("Connecting to input '{}'".format(address))
 
@@ -52,25 +75,20 @@ def connect_rm(*, address, key, password):
 
     # open key at provided path
     def use_key(key):
-        for key_type in [paramiko.RSAKey, paramiko.Ed25519Key, paramiko.ECDSAKey]:
-            try:
-                pkey = key_type.from_private_key_file(os.path.expanduser(key))
-                break
-            except paramiko.ssh_exception.PasswordRequiredException:
+        path = os.path.expanduser(key)
+        # the key type is read from the file, rather than trying each type
+        try:
+            return paramiko.PKey.from_path(path)
+        except paramiko.ssh_exception.PasswordRequiredException:
+            with prompt_lock:
                 passphrase = getpass(
-                    "Enter passphrase for key '{}': ".format(os.path.expanduser(key))
+                    "Enter passphrase for key '{}': ".format(path)
                 )
-                # try to read the file again, this time with the password
-                for key_type in [paramiko.RSAKey, paramiko.Ed25519Key, paramiko.ECDSAKey]:
-                    try:
-                        pkey = key_type.from_private_key_file(os.path.expanduser(key), password=passphrase)
-                        break
-                    except paramiko.ssh_exception.SSHException:
-                        continue
-                break
-            except paramiko.ssh_exception.SSHException:
-                continue
-        return pkey
+            # try to read the file again, this time with the password
+            return paramiko.PKey.from_path(path, passphrase=passphrase)
+        except (paramiko.ssh_exception.SSHException, paramiko.pkey.UnknownKeyType) as e:
+            log.debug(f"Could not load key '{path}': {e}")
+            return None
 
     # use provided key
     if key is not None:
@@ -89,18 +107,62 @@ def connect_rm(*, address, key, password):
         pkey = use_key(default_key)
     # finally prompt user for password
     elif not agent.get_keys():
-        password = getpass(
-            "Password for '{}': ".format(address)
-        )
+        with prompt_lock:
+            password = getpass(
+                "Password for '{}': ".format(address)
+            )
         pkey = None
 
+    prof = profiles[transport]
     client.connect(
         address,
         username='root',
         password=password,
         pkey=pkey,
         look_for_keys=False,
-        disabled_algorithms=dict(pubkeys=["rsa-sha2-512", "rsa-sha2-256"])
+        disabled_algorithms=dict(pubkeys=["rsa-sha2-512", "rsa-sha2-256"]),
+        timeout=connect_timeout,
+        banner_timeout=connect_timeout,
+        auth_timeout=connect_timeout,
+        compress=prof.compress,
+        transport_factory=transport_factory(prof),
+    )
+
+    if keepalive > 0:
+        client.get_transport().set_keepalive(keepalive)
+
+    log.debug(f"Using cipher {client.get_transport().local_cipher}")
+
+    return client
+
+
+def connect_rm(*, address, key, password, keepalive=0, transport='default', tcp=False,
+               tcp_remote=False):
+    """
+    Open a remote input device via SSH.
+
+    Args:
+        address (str): address to reMarkable
+        key (str, optional): path to reMarkable ssh key
+        password (str, optional): reMarkable ssh password
+        keepalive (float, optional): seconds between SSH keepalive packets
+            (0 disables keepalives)
+        transport (str, optional): name of transport profile to use
+        tcp (bool, optional): stream events over plain TCP instead of SSH
+        tcp_remote (bool, optional): allow plain TCP on addresses other than
+            the USB link
+    Returns:
+        (paramiko.ChannelFile): read-only stream of pen events
+        (paramiko.ChannelFile): read-only stream of touch events
+        (paramiko.ChannelFile): read-only stream of button events
+    """
+
+    client = open_client(
+        address=address,
+        key=key,
+        password=password,
+        keepalive=keepalive,
+        transport=transport,
     )
 
     session = client.get_transport().open_session()
@@ -115,28 +177,161 @@ def connect_rm(*, address, key, password):
     # https://github.com/Eeems/oxide/issues/48#issuecomment-690830572
     if pen_file == '/dev/input/event0':
         # rM 1
-        rm = reMarkable1(client)
+        rm = reMarkable1(client, tcp=tcp, tcp_remote=tcp_remote)
     elif pen_file == '/dev/input/event1':
         # rM 2
-        rm = reMarkable2(client)
+        rm = reMarkable2(client, tcp=tcp, tcp_remote=tcp_remote)
     elif pen_file == '/dev/input/event2':
         # rM Pro
-        rm = reMarkablePro(client)
+        rm = reMarkablePro(client, tcp=tcp, tcp_remote=tcp_remote)
     else:
         raise ValueError(f"Could not detect reMarkable version. {pen_file}")
 
     log.debug("Detected {type(rm).__name__}")
     log.debug(f'Pen:{rm.pen_file}\nTouch:{rm.touch_file}\nButton:{rm.button_file}')
+    log.info(f"Connected to {address}")
 
     return rm
 
+def parse_region(value):
+    """Region setting: a boolean, or x,y,width,height in pixels"""
+    if ',' in value:
+        x, y, width, height = map(int, value.split(','))
+        return x, y, width, height
+    return value.lower() not in ('0', 'false', 'no')
+
+# settings which may be given per tablet after --address
+target_options = {
+    'key': str,
+    'password': str,
+    'mode': ['fit', 'fill', 'stretch'],
+    'orientation': ['top', 'left', 'right', 'bottom'],
+    'monitor': int,
+    'region': parse_region,
+    'threshold': int,
+}
+# settings which can be reloaded while running
+mapping_options = ('mode', 'orientation', 'monitor', 'region', 'threshold')
+
+
+def parse_setting(name, value):
+    """Convert a per-tablet setting from text
+
+    Raises:
+        ValueError: unknown setting or invalid value
+    """
+    kind = target_options.get(name)
+    if kind is None:
+        raise ValueError(f"unknown setting '{name}'")
+    elif isinstance(kind, list):
+        if value not in kind:
+            raise ValueError(f"invalid {name} '{value}'")
+        return value
+    try:
+        return kind(value)
+    except ValueError:
+        raise ValueError(f"invalid {name} '{value}'")
+
+
+def parse_targets(parser, args):
+    """Expand --address options into per-tablet settings
+
+    Args:
+        parser (argparse.ArgumentParser): parser used for error reporting
+        args (argparse.Namespace): parsed command line
+
+    Returns:
+        list of argparse.Namespace, one per tablet, with settings not given
+        for a tablet taken from the global options
+    """
+    targets = []
+    for spec in args.address or ['10.11.99.1']:
+        address, *parts = spec.split(',')
+        target = argparse.Namespace(
+            address=address,
+            **{name: getattr(args, name) for name in target_options}
+        )
+        # a part without '=' continues the previous value, e.g. region=0,0,1920,1080
+        settings = []
+        for part in parts:
+            if settings and '=' not in part:
+                settings[-1] += ',' + part
+            else:
+                settings.append(part)
+        for setting in settings:
+            name, _, value = setting.partition('=')
+            try:
+                setattr(target, name, parse_setting(name, value))
+            except ValueError as e:
+                parser.error(f"{e} for {address}")
+        targets.append(target)
+    return targets
+
+
+def read_config(path, target):
+    """Apply mapping settings from a config file to a tablet
+
+    The [remouse] section applies to every tablet and a section named after
+    a tablet's address overrides it, e.g.
+
+        [remouse]
+        orientation = left
+
+        [10.11.99.1]
+        region = 0,0,1920,1080
+
+    Args:
+        path (str): config file
+        target (argparse.Namespace): settings of one tablet
+
+    Returns:
+        argparse.Namespace: copy of `target` with the file's settings applied
+
+    Raises:
+        ValueError: invalid setting in the file
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        log.warning(f"Config file '{path}' not found")
+    target = argparse.Namespace(**vars(target))
+    for section in ('remouse', target.address):
+        if not config.has_section(section):
+            continue
+        for name, value in config.items(section):
+            if name not in mapping_options:
+                raise ValueError(f"unknown setting '{name}' in [{section}]")
+            value = parse_setting(name, value)
+            if value is True:
+                # no region selection GUI while running
+                raise ValueError("region in the config file must be x,y,width,height")
+            setattr(target, name, value)
+    return target
+
+
+def sink_settings(target):
+    """Keyword arguments of an output backend for a tablet"""
+    return dict(
+        orientation=target.orientation,
+        monitor_num=target.monitor,
+        region=target.region,
+        threshold=target.threshold,
+        mode=target.mode,
+    )
+
+
 def main():
     try:
         parser = argparse.ArgumentParser(description="use reMarkable tablet as a mouse input")
+        parser.add_argument('command', nargs='?', choices=['daemon', 'attach', 'detach'], help="""daemon: keep the tablet connection open in the background and publish frames to local subscribers.
+        attach: make a running daemon move the cursor using the given mapping and backend options.
+        detach: make a running daemon stop moving the cursor""")
         parser.add_argument('--debug', action='store_true', default=False, help="enable debug messages")
         parser.add_argument('--key', type=str, metavar='PATH', help="ssh private key")
         parser.add_argument('--password', default=None, type=str, help="ssh password")
-        parser.add_argument('--address', default='10.11.99.1', type=str, help="device address")
+        parser.add_argument('--address', action='append', type=str, help="""device address (default 10.11.99.1).
+        Repeat to serve several tablets, each optionally followed by per-tablet
+        settings, e.g. 10.11.99.1,orientation=left,mode=fit,monitor=1 or
+        10.11.99.2,region=0,0,1920,1080 (x,y,width,height in pixels)""")
         parser.add_argument('--mode', default='fill', choices=['fit', 'fill', 'stretch'], help="""Scale setting.
         Fit (default): take up the entire tablet, but not necessarily the entire monitor.
         Fill: take up the entire monitor, but not necessarily the entire tablet.
@@ -144,8 +339,36 @@ def main():
         parser.add_argument('--orientation', default='right', choices=['top', 'left', 'right', 'bottom'], help="position of tablet buttons")
         parser.add_argument('--monitor', default=0, type=int, metavar='NUM', help="monitor to output to")
         parser.add_argument('--region', action='store_true', default=False, help="Use a GUI to position the output area. Overrides --monitor")
-        parser.add_argument('--threshold', metavar='THRESH', default=600, type=int, help="stylus pressure threshold (default 600)")
+        parser.add_argument('--threshold', metavar='THRESH', default=0, type=int, help="stylus pressure needed for contact with --evdev, 0 to use the tablet's (default 0)")
         parser.add_argument('--evdev', action='store_true', default=False, help="use evdev to support pen pressure (requires root, Linux only)")
+        parser.add_argument('--touch', action='store_true', default=False, help="also use the touchscreen: multitouch with --evdev, otherwise a trackpad with scroll and pinch to zoom")
+        parser.add_argument('--pressure-curve', metavar='CURVE', default='linear', type=str, help="pressure response with --evdev: linear, gamma:G, points:X,Y;X,Y;... or file:PATH (default linear)")
+        parser.add_argument('--tilt-curve', metavar='CURVE', default='linear', type=str, help="tilt response with --evdev, same forms as --pressure-curve plus scale:S (default linear)")
+        parser.add_argument('--keepalive', metavar='SECS', default=5, type=float, help="interval between SSH keepalive packets, 0 to disable (default 5)")
+        parser.add_argument('--stall-timeout', metavar='SECS', default=3, type=float, help="reconnect if no data arrives for this long while the pen is in range, 0 to disable (default 3)")
+        parser.add_argument('--transport', default='lowlatency', choices=profiles.keys(), help="SSH transport profile (default lowlatency)")
+        parser.add_argument('--tcp', action='store_true', default=False, help="stream events over unencrypted TCP, falling back to SSH (USB link only)")
+        parser.add_argument('--tcp-remote', action='store_true', default=False, help="allow --tcp on addresses other than the USB link, e.g. trusted Wi-Fi (events are not encrypted)")
+        parser.add_argument('--benchmark-transport', action='store_true', default=False, help="measure throughput and latency of each transport profile, then exit")
+        parser.add_argument('--reader-process', action='store_true', default=False, help="read and decode events in a separate process (Linux/macOS only)")
+        parser.add_argument('--socket', metavar='PATH', type=str, help="frame socket of the daemon (default {})".format(default_socket()))
+        parser.add_argument('--subscribe', action='store_true', default=False, help="read frames from a running daemon instead of connecting to the tablet")
+        parser.add_argument('--state', metavar='PATH', nargs='?', const=True, help="publish the latest pen state to a memory mapped file for overlays (default {})".format(default_state()))
+        parser.add_argument('--rule', metavar='RULE', action='append', type=str, help="change how pen events are read, e.g. 'map BTN_STYLUS BTN_RIGHT', 'drop ABS_TILT_X ABS_TILT_Y' or 'clamp ABS_PRESSURE 0 3000', repeatable")
+        parser.add_argument('--rules', metavar='PATH', type=str, help="read --rule lines from a file, applied before those on the command line")
+        parser.add_argument('--hover-rate', metavar='HZ', default=0, type=float, help="maximum rate of pen updates while hovering, 0 for no limit (default 0)")
+        parser.add_argument('--smoothing', metavar='HZ', default=0, type=float, help="smooth the position of a slow moving pen, lower is smoother, 0 to disable (default 0, try 1)")
+        parser.add_argument('--deadband', metavar='UNITS', default=0, type=float, help="ignore pen movements smaller than this many tablet units, 0 to disable (default 0)")
+        parser.add_argument('--predict', metavar='MS', default=0, type=float, help="extrapolate the cursor this far ahead to hide latency, e.g. half the RTT from --benchmark-transport, 0 to disable (default 0)")
+        parser.add_argument('--record', metavar='PATH', type=str, help="save raw pen frames for 'python -m remarkable_mouse.bench predict'")
+        parser.add_argument('--gc-freeze', action='store_true', default=False, help="exclude everything allocated at startup from garbage collection, avoiding collection pauses while drawing")
+        parser.add_argument('--monitor-poll', metavar='SECS', default=2, type=float, help="check for added or removed monitors every SECS seconds, 0 to disable (default 2)")
+        parser.add_argument('--config', metavar='PATH', type=str, help="read mapping settings from an INI file, reloaded on SIGHUP")
+        parser.add_argument('--trace', metavar='FILE', type=str, help="record pipeline stages as a Chrome/Perfetto trace, written on exit or SIGUSR1")
+        parser.add_argument('--profile', metavar='FILE', type=str, help="where SIGUSR2 toggled profiling writes collapsed stacks (default {})".format(default_profile()))
+        parser.add_argument('--metrics', metavar='ADDR', type=str, help="serve Prometheus metrics on PORT, HOST:PORT or a UNIX socket path, e.g. 9464 or metrics.sock")
+        parser.add_argument('--top', action='store_true', default=False, help="show live rates, stage latencies and CPU use full screen, with attach those of the daemon (Linux/macOS)")
+        parser.add_argument('--stats', metavar='SECS', default=0, type=float, help="log session statistics every SECS seconds")
 
         args = parser.parse_args()
 
@@ -155,31 +378,253 @@ def main():
         else:
             log.setLevel(logging.INFO)
 
-        # ----- Connect to device -----
+        if args.touch and (args.command or args.reader_process or args.subscribe):
+            parser.error("--touch doesn't work with daemons, --reader-process or --subscribe")
 
-        rm = connect_rm(
-            address=args.address,
-            key=args.key,
-            password=args.password,
-        )
-        print("Connected to", args.address)
+        targets = parse_targets(parser, args)
+        if args.config:
+            try:
+                targets = [read_config(args.config, target) for target in targets]
+            except (ValueError, configparser.Error) as e:
+                parser.error(f"{args.config}: {e}")
+        for target in targets:
+            # select regions now, so reloading the mapping never opens the GUI
+            if target.region is True and args.command not in ('daemon', 'detach'):
+                target.region = get_region(target.orientation)
+
+        # pen event rules, frames from --subscribe were already assembled by the daemon
+        try:
+            rules = EventRules((load_rules(args.rules) if args.rules else []) + (args.rule or []))
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+
+        if args.command == 'attach':
+            # the daemon assembles and filters frames, attach only sets its output
+            fixed = [
+                name for name, given in (
+                    ('--rule', args.rule), ('--rules', args.rules),
+                    ('--smoothing', args.smoothing), ('--deadband', args.deadband),
+                    ('--predict', args.predict), ('--record', args.record), ('--state', args.state),
+                    ('--pressure-curve', args.pressure_curve != 'linear'),
+                    ('--tilt-curve', args.tilt_curve != 'linear'),
+                ) if given
+            ]
+            if fixed:
+                parser.error(f"{', '.join(fixed)} can't be changed with attach")
+
+        if args.command in ('attach', 'detach'):
+            target = targets[0]
+            path = control_socket(args.socket or default_socket())
+            try:
+                if args.command == 'detach':
+                    control(path, 'detach')
+                    print("Detached from daemon")
+                    return
+                control(
+                    path, 'attach',
+                    backend='evdev' if args.evdev else 'pynput',
+                    **sink_settings(target)
+                )
+            except OSError as e:
+                parser.error(f"no daemon on {path}: {e}")
+            except RuntimeError as e:
+                parser.error(f"daemon couldn't {args.command}: {e}")
+            print("Attached to daemon")
+            if args.top:
+                from remarkable_mouse.top import TopView
+                async def sample():
+                    # control() blocks, keep it off the UI loop
+                    loop = asyncio.get_running_loop()
+                    return [await loop.run_in_executor(None, control, path, 'stats')]
+                asyncio.run(TopView(sample).run())
+            return
+
+        if args.benchmark_transport:
+            target = targets[0]
+            print_benchmark(benchmark_transport(
+                lambda transport: open_client(
+                    address=target.address,
+                    key=target.key,
+                    password=target.password,
+                    transport=transport,
+                )
+            ))
+            return
 
-        # ----- Handle events -----
+        # backend specific settings
+        options = {}
 
-        if args.evdev:
-            from remarkable_mouse.evdev import read_tablet
+        if args.command == 'daemon':
+            Sink = None
+
+        elif args.evdev:
+            from remarkable_mouse.evdev import EvdevSink as Sink
+            try:
+                options = dict(
+                    pressure_curve=parse_curve(args.pressure_curve),
+                    tilt_curve=parse_curve(args.tilt_curve),
+                )
+            except ValueError as e:
+                parser.error(str(e))
 
         else:
-            from remarkable_mouse.pynput import read_tablet
-
-        read_tablet(
-            rm,
-            orientation=args.orientation,
-            monitor_num=args.monitor,
-            region=args.region,
-            threshold=args.threshold,
-            mode=args.mode,
+            from remarkable_mouse.pynput import PynputSink as Sink
+
+        tablets = []
+        servers = []
+        # state files and recordings to close on exit
+        closing = []
+        tracer = Tracer(args.trace) if args.trace else None
+        # profile the live session on demand, without reconnecting
+        sampler = StackSampler(args.profile or default_profile())
+        for num, target in enumerate(targets):
+            stats = Stats(
+                settings=dict(
+                    address=target.address,
+                    mode=target.mode,
+                    orientation=target.orientation,
+                    keepalive=args.keepalive,
+                    stall_timeout=args.stall_timeout,
+                    transport=args.transport,
+                ),
+            )
+
+            # ----- Connect to device -----
+
+            # a partial rather than a closure so it can be sent to a reader process
+            connect = functools.partial(
+                connect_rm,
+                address=target.address,
+                key=target.key,
+                password=target.password,
+                keepalive=args.keepalive,
+                transport=args.transport,
+                tcp=args.tcp,
+                tcp_remote=args.tcp_remote,
+            )
+
+            # ----- Handle events -----
+
+            path = args.socket or default_socket(num)
+            if num and args.socket:
+                path += f'-{num}'
+
+            if args.command == 'daemon':
+                server = FrameServer(path, stats)
+                router = Router(server)
+                servers += [server, ControlServer(control_socket(path), router, stats)]
+                make_sink = router.bind
+            else:
+                def make_sink(rm, target=target):
+                    return Sink(rm, **sink_settings(target), **options)
+
+            if args.predict:
+                def make_sink(rm, make_sink=make_sink):
+                    return Predictor(make_sink(rm), lead=args.predict / 1000)
+
+            if args.smoothing or args.deadband:
+                def make_sink(rm, make_sink=make_sink, stats=stats):
+                    return JitterFilter(
+                        make_sink(rm),
+                        min_cutoff=args.smoothing,
+                        deadband=args.deadband,
+                        stats=stats,
+                    )
+
+            if args.record:
+                record_path = args.record + (f'-{num}' if num else '')
+                def make_sink(rm, make_sink=make_sink, record_path=record_path):
+                    recorder = Recorder(make_sink(rm), record_path)
+                    closing.append(recorder)
+                    return recorder
+
+            # overlays read the pen as the tablet reports it, before any filter
+            if args.state:
+                state_path = default_state(num) if args.state is True else args.state
+                if num and args.state is not True:
+                    state_path += f'-{num}'
+                writer = StateWriter(state_path, make_sink)
+                closing.append(writer)
+                make_sink = writer.bind
+
+            if args.gc_freeze:
+                def make_sink(rm, make_sink=make_sink):
+                    sink = make_sink(rm)
+                    # the connection and sink live for the whole session, so
+                    # collections would only ever rescan them
+                    gc.collect()
+                    gc.freeze()
+                    return sink
+
+            if args.subscribe:
+                tablets.append(SubscriberTablet(path, make_sink, stats=stats))
+            elif args.reader_process:
+                tablets.append(RingTablet(
+                    connect, make_sink,
+                    stats=stats,
+                    stall_timeout=args.stall_timeout,
+                    hover_rate=args.hover_rate,
+                    rules=rules,
+                ))
+            else:
+                tablets.append(Tablet(
+                    connect, make_sink,
+                    stats=stats,
+                    stall_timeout=args.stall_timeout,
+                    hover_rate=args.hover_rate,
+                    touch=args.touch,
+                    tracer=tracer,
+                    # daemons always time stages, for attach --top
+                    latency=bool(args.metrics or args.top or args.command == 'daemon'),
+                    rules=rules,
+                ))
+
+        def reload():
+            """Recompute every mapping from the command line and config file"""
+            log.info("Reloading mapping settings")
+            for tablet, target in zip(tablets, targets):
+                if tablet.sink is None:
+                    continue
+                try:
+                    if args.config:
+                        target = read_config(args.config, target)
+                    # a daemon's output keeps the settings given with attach
+                    tablet.sink.configure(**sink_settings(target))
+                    if args.command != 'daemon':
+                        tablet.stats.settings.update(mode=target.mode, orientation=target.orientation)
+                except (ValueError, configparser.Error) as e:
+                    log.error(f"Keeping previous mapping of {target.address}: {e}")
+
+        if sys.platform == 'win32':
+            # the default proactor loop can't wait on the paramiko channel pipes
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        top = None
+        if args.top:
+            from remarkable_mouse.top import TopView
+            top = TopView(lambda: [tablet.stats.sample() for tablet in tablets])
+        run_options = dict(
+            interval=args.stats,
+            reload=reload,
+            layout_poll=args.monitor_poll,
+            handlers=dict(
+                SIGUSR2=sampler.toggle,
+                **({'SIGUSR1': tracer.flush} if tracer else {}),
+            ),
+            metrics=MetricsExporter(args.metrics, tablets) if args.metrics else None,
+            top=top,
         )
+        try:
+            if servers:
+                asyncio.run(run_daemon(tablets, servers, **run_options))
+            else:
+                asyncio.run(run(tablets, **run_options))
+        finally:
+            for stage in closing:
+                stage.close()
+            if tracer is not None:
+                tracer.flush()
+            if sampler.running:
+                sampler.stop()
 
     except PermissionError:
         log.error('Insufficient permissions for creating a virtual input device')
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import multiprocessing
+import operator
+import os
+import pickle
+import struct
+import sys
+from multiprocessing import shared_memory
+
+from .common import model_name, models
+from .core import Tablet
+from .frames import FrameBatch, PenFrame, batched
+from .stats import Stats
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+
+class FrameRing:
+    """Ring buffer of PenFrame records in shared memory
+
+    A single writer stores each frame in the next slot and then publishes the
+    total number of frames written in the header.  Readers never block the
+    writer: a reader which falls `capacity` frames behind loses the oldest
+    ones.  The writer may already be overwriting the slot after the last one
+    published, so a reader discards any record whose slot the writer had
+    reached by the time it finished copying.
+
+    The writer also publishes the session counters only it can update, see
+    publish().
+
+    Args:
+        name (str, optional): name of an existing ring to attach to
+        capacity (int): number of frame slots when creating a new ring
+    """
+
+    # frames written so far, number of slots
+    header = struct.Struct('<QQ')
+    # Stats counters kept by the reader process, stored after the header
+    counters = ('events', 'suppressed', 'bytes', 'stalls', 'reconnects')
+    counter_values = struct.Struct(f'<{len(counters)}Q')
+    records = header.size + counter_values.size
+
+    def __init__(self, name=None, capacity=1024):
+        record = PenFrame.record
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=self.records + capacity * record.size
+            )
+            self.header.pack_into(self.shm.buf, 0, 0, capacity)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            _, capacity = self.header.unpack_from(self.shm.buf)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.capacity = capacity
+        self.seq = 0
+        self.read_seq = 0
+        # scratch frame records are read into
+        self.frame = PenFrame()
+        self.get_counters = operator.attrgetter(*self.counters)
+
+    def _offset(self, seq):
+        return self.records + (seq % self.capacity) * PenFrame.record.size
+
+    def write(self, frame):
+        """Append a frame (writer side)"""
+        frame.pack_into(self.buf, self._offset(self.seq))
+        self.seq += 1
+        self.header.pack_into(self.buf, 0, self.seq, self.capacity)
+
+    def write_batch(self, frames):
+        """Append several frames (writer side)
+
+        Each frame is published as soon as it's written, so readers can
+        tell which slot is being overwritten.
+        """
+        buf = self.buf
+        header = self.header
+        for frame in frames:
+            frame.pack_into(buf, self._offset(self.seq))
+            self.seq += 1
+            header.pack_into(buf, 0, self.seq, self.capacity)
+
+    def publish(self, stats):
+        """Store the reader process counters of `stats` (writer side)"""
+        self.counter_values.pack_into(self.buf, self.header.size, *self.get_counters(stats))
+
+    def merge(self, stats):
+        """Copy the published counters into `stats` (reader side)
+
+        Each counter is read whole, but they may come from different
+        batches.
+        """
+        values = self.counter_values.unpack_from(self.buf, self.header.size)
+        for name, value in zip(self.counters, values):
+            setattr(stats, name, value)
+
+    def drain(self, batch):
+        """Collect every unread frame (reader side)
+
+        Args:
+            batch (FrameBatch): cleared, then filled with the frames in order
+
+        Returns:
+            int: number of frames lost because the reader fell behind
+        """
+        batch.clear()
+        frame = self.frame
+        dropped = 0
+        seq, _ = self.header.unpack_from(self.buf)
+        if seq - self.read_seq > self.capacity:
+            dropped += seq - self.capacity - self.read_seq
+            self.read_seq = seq - self.capacity
+        while self.read_seq < seq:
+            frame.unpack_from(self.buf, self._offset(self.read_seq))
+            # discard the record if the writer reached its slot while we were
+            # copying it: frame number `latest` goes into the same slot
+            latest, _ = self.header.unpack_from(self.buf)
+            if latest - self.read_seq >= self.capacity:
+                dropped += 1
+            else:
+                batch.add(frame)
+            self.read_seq += 1
+        return dropped
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class RingSink:
+    """Reader process side: write frames to the ring and ring the doorbell
+
+    Counters of `stats` are published along with every batch of frames.
+
+    Args:
+        ring (FrameRing): shared ring to write to
+        conn (multiprocessing.Connection): pipe to the parent process
+        stats (Stats): counters of the reader process
+    """
+
+    def __init__(self, ring, conn, stats):
+        self.ring = ring
+        self.conn = conn
+        self.stats = stats
+        self.fd = None
+
+    def bind(self, rm):
+        """Tell the parent which model connected, used as make_sink"""
+        self.conn.send(model_name(rm))
+        # after the model name the pipe only carries wakeups
+        self.fd = self.conn.fileno()
+        os.set_blocking(self.fd, False)
+        return self
+
+    def send(self, frame):
+        self.ring.write(frame)
+        self.ring.publish(self.stats)
+        self.wake()
+
+    def send_batch(self, frames):
+        self.ring.write_batch(frames)
+        self.ring.publish(self.stats)
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.fd, b'\0')
+        except BlockingIOError:
+            # parent already has wakeups pending
+            pass
+
+
+def reader_main(connect, ring_name, conn, stall_timeout, hover_rate, log_level, rules=None):
+    """Entry point of the reader process
+
+    An error before the tablet connects is sent to the parent in place of
+    the model name, so it's raised there.  Later errors are logged and end
+    the process with a nonzero exit code.
+    """
+    log.setLevel(log_level)
+    ring = FrameRing(ring_name)
+    stats = Stats()
+    sink = RingSink(ring, conn, stats)
+    tablet = Tablet(
+        connect, sink.bind,
+        stats=stats, stall_timeout=stall_timeout, hover_rate=hover_rate, rules=rules
+    )
+    try:
+        asyncio.run(tablet.run())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        if sink.fd is None:
+            try:
+                # the parent has to be able to unpickle it
+                pickle.loads(pickle.dumps(e))
+            except Exception:
+                e = RuntimeError(f"{type(e).__name__}: {e}")
+            conn.send(e)
+        else:
+            log.error(f"Reader process failed: {type(e).__name__}: {e}")
+        sys.exit(1)
+    finally:
+        ring.close()
+
+
+class RingTablet:
+    """A tablet read and decoded by a separate process
+
+    The reader process owns the SSH connection and writes frames into a
+    FrameRing, so decoding never competes with the output backend for the
+    GIL.  Its event, byte, stall and reconnect counters are merged into
+    `stats` whenever frames arrive.  Same interface as Tablet.
+
+    Args:
+        connect (function): picklable function returning a connected reMarkable
+        make_sink (function): takes a reMarkable and returns an output backend
+            with a send(frame) and optionally a send_batch(frames) method
+        stats (Stats): session counters
+        stall_timeout (float): seconds without data before reconnecting
+        hover_rate (float): maximum frames per second while hovering (0 for
+            no limit)
+        capacity (int): number of frames the ring can hold
+        rules (EventRules, optional): how pen events update frames, sent to
+            the reader process
+    """
+
+    def __init__(self, connect, make_sink, *, stats, stall_timeout, hover_rate=0, capacity=1024,
+                 rules=None):
+        self.connect = connect
+        self.make_sink = make_sink
+        self.stats = stats
+        self.stall_timeout = stall_timeout
+        self.hover_rate = hover_rate
+        self.capacity = capacity
+        self.rules = rules
+        self.sink = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        ring = FrameRing(capacity=self.capacity)
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(
+            target=reader_main,
+            args=(
+                self.connect, ring.name, child_conn,
+                self.stall_timeout, self.hover_rate, log.level, self.rules
+            ),
+            daemon=True,
+        )
+        proc.start()
+        child_conn.close()
+
+        ready = asyncio.Event()
+        fd = conn.fileno()
+        try:
+            try:
+                model = await loop.run_in_executor(None, conn.recv)
+            except EOFError:
+                await loop.run_in_executor(None, proc.join)
+                raise RuntimeError(f"Reader process exited with code {proc.exitcode}")
+            if isinstance(model, Exception):
+                raise model
+            self.stats.settings['model'] = model
+            self.sink = self.make_sink(models[model]())
+            send_batch = batched(self.sink)
+
+            os.set_blocking(fd, False)
+            loop.add_reader(fd, ready.set)
+            batch = FrameBatch()
+            while True:
+                await ready.wait()
+                ready.clear()
+                try:
+                    if not os.read(fd, 4096):
+                        await loop.run_in_executor(None, proc.join)
+                        if proc.exitcode:
+                            raise RuntimeError(f"Reader process exited with code {proc.exitcode}")
+                        log.info("Reader process exited")
+                        return
+                except BlockingIOError:
+                    continue
+                dropped = ring.drain(batch)
+                if batch.frames:
+                    send_batch(batch.frames)
+                self.stats.dropped += dropped
+                self.stats.frames = ring.read_seq - self.stats.dropped
+                ring.merge(self.stats)
+        finally:
+            loop.remove_reader(fd)
+            conn.close()
+            proc.terminate()
+            proc.join()
+            ring.close()
+            ring.unlink()
@@ -0,0 +1,123 @@
+import logging
+
+from .common import models
+from .frames import EV_ABS, EV_KEY, abs_fields, button_bits, code
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+
+def event_code(name):
+    """(type, code) of a pen event name usable in rules, e.g. 'ABS_X'"""
+    try:
+        e_type, e_code = code(name)
+    except KeyError:
+        raise ValueError(f"Unknown event '{name}'")
+    if e_type not in (EV_ABS, EV_KEY):
+        raise ValueError(f"Rules only apply to EV_ABS and EV_KEY events, not '{name}'")
+    return e_type, e_code
+
+
+class EventRules:
+    """Pen event rules compiled into the tables FrameAssembler dispatches on
+
+    Each rule is one line, applied in order:
+
+        drop EVENT...            ignore these events, e.g. drop ABS_TILT_X ABS_TILT_Y
+        map EVENT TARGET         treat EVENT as TARGET, e.g. map BTN_STYLUS BTN_RIGHT
+                                 (axes only map to axes with the same range)
+        clamp EVENT LOW HIGH     limit the value of an axis, e.g. clamp ABS_PRESSURE 0 3000
+
+    A later rule for the same event overrides earlier ones, so --rule can
+    adjust a rules file: clamping again replaces the bounds, and clamping
+    or mapping a dropped event reads it again.
+
+    Rules change which PenFrame attribute or button bit each event code
+    updates, so an event without a rule costs the same dictionary lookup
+    as with no rules at all.  Clamped axes are kept in a second table which
+    is only consulted for codes missing from the first.
+
+    Args:
+        rules (list of str): rules to compile
+
+    Attributes:
+        abs_fields (dict): EV_ABS code -> PenFrame attribute
+        button_bits (dict): EV_KEY code -> PenFrame.buttons bit
+        clamp (dict): EV_ABS code -> (PenFrame attribute, low, high)
+    """
+
+    def __init__(self, rules=()):
+        self.abs_fields = dict(abs_fields)
+        self.button_bits = dict(button_bits)
+        self.clamp = {}
+        for rule in rules:
+            self.add(rule)
+
+    def table(self, e_type):
+        return self.abs_fields if e_type == EV_ABS else self.button_bits
+
+    def add(self, rule):
+        """Compile one rule
+
+        Raises:
+            ValueError: if the rule is malformed
+        """
+        words = rule.split('#')[0].split()
+        if not words:
+            return
+        action, *args = words
+        if action == 'drop' and args:
+            for name in args:
+                e_type, e_code = event_code(name)
+                self.table(e_type).pop(e_code, None)
+                self.clamp.pop(e_code, None)
+
+        elif action == 'map' and len(args) == 2:
+            (e_type, e_code), (target_type, target_code) = map(event_code, args)
+            if e_type != target_type:
+                raise ValueError(f"Can't map {args[0]} to an event of another type")
+            default = abs_fields if e_type == EV_ABS else button_bits
+            if target_code not in default:
+                raise ValueError(f"{args[1]} isn't a pen event")
+            if e_type == EV_ABS and e_code in abs_fields:
+                # backends scale each axis by its own range
+                source, target = 'pen_' + abs_fields[e_code], 'pen_' + default[target_code]
+                for model in models.values():
+                    if getattr(model, source)[:2] != getattr(model, target)[:2]:
+                        raise ValueError(f"Can't map {args[0]} to {args[1]}, their ranges differ")
+            self.table(e_type)[e_code] = default[target_code]
+            self.clamp.pop(e_code, None)
+
+        elif action == 'clamp' and len(args) == 3:
+            e_type, e_code = event_code(args[0])
+            try:
+                low, high = int(args[1]), int(args[2])
+            except ValueError:
+                raise ValueError(f"Bounds of '{rule}' must be integers")
+            if low > high:
+                raise ValueError(f"Lower bound of '{rule}' is above the upper bound")
+            if e_type != EV_ABS:
+                raise ValueError(f"Can't clamp {args[0]}, it isn't an axis")
+            # keep what earlier rules made of the axis, a dropped axis is
+            # read again
+            if e_code in self.clamp:
+                field = self.clamp[e_code][0]
+            else:
+                field = self.abs_fields.pop(e_code, None) or abs_fields.get(e_code)
+            if field is None:
+                raise ValueError(f"Can't clamp {args[0]}, it isn't a pen axis")
+            self.clamp[e_code] = (field, low, high)
+
+        else:
+            raise ValueError(f"Invalid rule '{rule}'")
+        log.debug(f"Event rule: {rule}")
+
+
+def load_rules(path):
+    """Rules from a file, one per line with # comments
+
+    Returns:
+        list of str
+    """
+    with open(path) as f:
+        return f.read().splitlines()
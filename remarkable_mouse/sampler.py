@@ -0,0 +1,69 @@
+import logging
+import os
+import signal
+import tempfile
+from collections import Counter
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+
+def default_profile():
+    """Path of the collapsed stacks written by a StackSampler"""
+    return os.path.join(tempfile.gettempdir(), f'remouse-{os.getpid()}.stacks')
+
+
+class StackSampler:
+    """Statistical profiler sampling the main thread's stack (Unix only)
+
+    A SIGPROF timer interrupts the process every `interval` seconds of CPU
+    time and the handler records the stack it interrupted, so the profiled
+    code runs unmodified and the cost doesn't grow with the number of calls.
+    A sampling thread would instead mostly see the main thread wherever it
+    released the GIL.  Results are written as collapsed stacks ("outer;inner
+    count" lines), the input of flamegraph.pl, speedscope and similar tools.
+
+    Args:
+        path (str): file written when sampling stops
+        interval (float): seconds of CPU time between samples
+    """
+
+    def __init__(self, path, interval=0.002):
+        self.path = path
+        self.interval = interval
+        self.counts = Counter()
+        self.running = False
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+            ))
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.counts.clear()
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        log.info("Profiling started")
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks"""
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.running = False
+        with open(self.path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
+        log.info(f"Profiling stopped, wrote {sum(self.counts.values())} samples to {self.path}")
+
+    def toggle(self):
+        """Start or stop sampling, used as a signal handler"""
+        if self.running:
+            self.stop()
+        else:
+            self.start()
@@ -0,0 +1,143 @@
+import logging
+import mmap
+import os
+import struct
+
+from .common import model_name, models
+from .daemon import default_socket
+from .frames import PenFrame, Stage, abs_fields, batched
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+# sequence number, then magic and model name, then one PenFrame.record
+seq = struct.Struct('<Q')
+header = struct.Struct('<Q4s16s4x')
+magic = b'RMS1'
+size = header.size + PenFrame.record.size
+
+
+def default_state(index=0):
+    """Path of the pen state file for the `index`th tablet"""
+    return os.path.splitext(default_socket(index))[0] + '.state'
+
+
+class StateWriter(Stage):
+    """Publish the latest pen state to a memory mapped file
+
+    The file holds a single frame guarded by a seqlock: the sequence number
+    is odd while the frame is being written and even once it is complete, so
+    readers can take a consistent snapshot without locks or syscalls.
+
+    Args:
+        path (str): state file to create
+        make_sink (function, optional): takes a reMarkable and returns an
+            output backend which receives every frame after it is published
+    """
+
+    # overlays may use any field, so hover frames are kept for all of them
+    fields = tuple(abs_fields.values())
+
+    def __init__(self, path, make_sink=None):
+        super().__init__(None)
+        self.path = path
+        self.make_sink = make_sink
+        self.mm = None
+        self.seq = 0
+
+    def bind(self, rm):
+        """Create the state file for the connected model, used as make_sink"""
+        if self.mm is None:
+            with open(self.path, 'w+b') as f:
+                os.chmod(self.path, 0o600)
+                f.truncate(size)
+                self.mm = mmap.mmap(f.fileno(), size)
+            log.info(f"Publishing pen state on {self.path}")
+        header.pack_into(self.mm, 0, self.seq, magic, model_name(rm).encode())
+        if self.make_sink is not None and self.sink is None:
+            self.sink = self.make_sink(rm)
+            self.send_next = batched(self.sink)
+        return self
+
+    def send(self, frame):
+        self.seq += 1
+        seq.pack_into(self.mm, 0, self.seq)
+        frame.pack_into(self.mm, header.size)
+        self.seq += 1
+        seq.pack_into(self.mm, 0, self.seq)
+        if self.sink is not None:
+            self.sink.send(frame)
+
+    def send_batch(self, frames):
+        # readers only see the latest state, so only the last frame is written
+        frame = frames[-1]
+        self.seq += 1
+        seq.pack_into(self.mm, 0, self.seq)
+        frame.pack_into(self.mm, header.size)
+        self.seq += 1
+        seq.pack_into(self.mm, 0, self.seq)
+        if self.sink is not None:
+            self.send_next(frames)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+            os.unlink(self.path)
+
+
+class StateReader:
+    """Read the pen state published by a StateWriter
+
+    Example:
+        state = StateReader(default_state())
+        frame = state.read()
+        print(frame.x, frame.y, frame.pressure)
+
+    Args:
+        path (str): state file of a running remouse
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        _, tag, model = header.unpack_from(self.mm)
+        if tag != magic:
+            raise ValueError("Not a remouse state file")
+        self.model = model.rstrip(b'\0').decode()
+
+    @property
+    def rm(self):
+        """(reMarkable): settings of the tablet, e.g. for axis ranges"""
+        return models[self.model]()
+
+    @property
+    def seq(self):
+        """(int): changes whenever a new frame is published"""
+        return seq.unpack_from(self.mm)[0]
+
+    def read(self, frame=None, tries=1000):
+        """Take a consistent snapshot of the latest frame
+
+        Args:
+            frame (PenFrame, optional): frame to overwrite instead of
+                allocating a new one
+            tries (int): attempts before giving up on a writer which stopped
+                halfway through a frame
+
+        Returns:
+            PenFrame, or None if no consistent snapshot could be taken
+        """
+        frame = frame or PenFrame()
+        mm = self.mm
+        for _ in range(tries):
+            before = seq.unpack_from(mm)[0]
+            if before & 1:
+                continue
+            frame.unpack_from(mm, header.size)
+            if seq.unpack_from(mm)[0] == before:
+                return frame
+        return None
+
+    def close(self):
+        self.mm.close()
@@ -0,0 +1,108 @@
+import bisect
+import logging
+import time
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+class Stats:
+    """Counters describing the health of a running session
+
+    Args:
+        settings (dict, optional): configuration values to include in reports
+    """
+
+    counters = (
+        'events', 'frames', 'touch_events', 'touch_frames', 'dropped', 'coalesced',
+        'suppressed', 'filtered', 'bytes', 'stalls', 'reconnects'
+    )
+    # current values rather than running totals
+    gauges = ('backlog',)
+
+    def __init__(self, settings=None):
+        self.settings = dict(settings or {})
+        for name in self.counters + self.gauges:
+            setattr(self, name, 0)
+        # Histogram of seconds spent in each pipeline stage, when measured
+        self.latency = {}
+        self.start = time.monotonic()
+
+    def snapshot(self):
+        """Current counter and setting values
+
+        Returns:
+            dict
+        """
+        snap = {name: getattr(self, name) for name in self.counters + self.gauges}
+        snap['uptime'] = time.monotonic() - self.start
+        snap.update(self.settings)
+        return snap
+
+    def sample(self):
+        """Snapshot with process CPU time and stage latency bucket counts,
+        for live views.  Only contains JSON serializable values
+
+        Returns:
+            dict
+        """
+        snap = self.snapshot()
+        snap['cpu'] = time.process_time()
+        snap['latency'] = {name: list(h.counts) for name, h in self.latency.items()}
+        return snap
+
+    def report(self):
+        """Log all counters and settings on one line"""
+        log.info(' '.join(
+            '{}={}'.format(k, round(v, 1) if isinstance(v, float) else v)
+            for k, v in self.snapshot().items()
+        ))
+
+
+class Histogram:
+    """Counts of values falling into fixed buckets, e.g. stage latencies
+
+    Attributes:
+        counts (list): number of values up to each bound in `buckets`, the
+            last entry counts values above all of them
+        sum (float): total of all values
+    """
+
+    # upper bounds in seconds
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def quantile(counts, q):
+    """Estimate a quantile from Histogram bucket counts
+
+    Interpolates linearly inside the bucket holding the quantile, like
+    Prometheus' histogram_quantile().
+
+    Args:
+        counts (list): Histogram.counts, or the difference of two of them
+        q (float): quantile between 0 and 1
+
+    Returns:
+        float: estimated value, None without observations, or inf if it
+            lies above the largest bucket
+    """
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if seen + count >= rank and count:
+            if i == len(Histogram.buckets):
+                return float('inf')
+            lower = Histogram.buckets[i - 1] if i else 0.
+            return lower + (Histogram.buckets[i] - lower) * (rank - seen) / count
+        seen += count
+    return float('inf')
@@ -0,0 +1,173 @@
+import asyncio
+import curses
+import logging
+import time
+from collections import deque
+
+from .stats import quantile
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+# (label, counter) of the rates shown for each tablet
+rates = (
+    ('events/s', 'events'),
+    ('frames/s', 'frames'),
+    ('touch events/s', 'touch_events'),
+    ('touch frames/s', 'touch_frames'),
+    ('dropped/s', 'dropped'),
+    ('coalesced/s', 'coalesced'),
+    ('suppressed/s', 'suppressed'),
+    ('filtered/s', 'filtered'),
+)
+percentiles = (0.5, 0.9, 0.99)
+
+
+def format_seconds(value):
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return '>100ms'
+    return f'{value * 1000:.3f}ms'
+
+
+def render(previous, current, elapsed):
+    """Lines of the view for one tablet
+
+    Rates and latency percentiles cover the time since the previous sample.
+
+    Args:
+        previous (dict): earlier Stats.sample() of the tablet
+        current (dict): latest Stats.sample() of the tablet
+        elapsed (float): seconds between the samples
+
+    Returns:
+        list of str
+    """
+    uptime = int(current['uptime'])
+    lines = [
+        '{}  {}  {}  up {}:{:02}:{:02}'.format(
+            current.get('address', 'tablet'), current.get('model', '?'),
+            current.get('transport', ''), uptime // 3600, uptime // 60 % 60, uptime % 60,
+        ),
+        '',
+    ]
+
+    def rate(name):
+        return (current[name] - previous.get(name, 0)) / elapsed
+
+    for label, name in rates:
+        lines.append(f'  {label:<16}{rate(name):>12.1f}')
+    lines.append('  {:<16}{:>12.1f}'.format('SSH KiB/s', rate('bytes') / 1024))
+    lines.append('  {:<16}{:>12}'.format('backlog bytes', current['backlog']))
+    lines.append('  {:<16}{:>12}'.format('reconnects', current['reconnects']))
+    lines.append('')
+
+    lines.append('  {:<16}'.format('stage') + ''.join(
+        f'{"p" + format(q * 100, "g"):>12}' for q in percentiles
+    ) + f'{"calls/s":>12}')
+    before = previous.get('latency', {})
+    for stage, counts in current['latency'].items():
+        old = before.get(stage, [0] * len(counts))
+        window = [a - b for a, b in zip(counts, old)]
+        lines.append(f'  {stage:<16}' + ''.join(
+            f'{format_seconds(quantile(window, q)):>12}' for q in percentiles
+        ) + f'{sum(window) / elapsed:>12.1f}')
+    if not current['latency']:
+        lines.append('  (no stage timings)')
+    return lines
+
+
+class LogTail(logging.Handler):
+    """Keep the last few log messages to show below the view"""
+
+    def __init__(self, size=5):
+        super().__init__()
+        self.messages = deque(maxlen=size)
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class TopView:
+    """Full screen view of live session stats, like top(1)
+
+    Args:
+        sample (function): returns a list of Stats.sample() dicts, one per
+            tablet, either from this process or from a daemon.  May be a
+            coroutine function; an OSError it raises is shown as the daemon
+            being disconnected until sampling works again
+        interval (float): seconds between refreshes
+    """
+
+    def __init__(self, sample, interval=0.25):
+        self.sample = sample
+        self.interval = interval
+
+    async def fetch(self):
+        samples = self.sample()
+        if asyncio.iscoroutine(samples):
+            samples = await samples
+        return samples
+
+    async def run(self):
+        """Show the view until 'q' is pressed"""
+        # log messages would scroll the screen, show them inside the view
+        tail = LogTail()
+        propagate, log.propagate = log.propagate, False
+        log.addHandler(tail)
+
+        screen = curses.initscr()
+        try:
+            curses.noecho()
+            curses.cbreak()
+            screen.nodelay(True)
+            try:
+                curses.curs_set(0)
+            except curses.error:
+                pass
+
+            # samples of the last refresh, empty until sampling works
+            previous = {}
+            cpu = 0.
+            last = time.monotonic()
+            while True:
+                try:
+                    samples = await self.fetch()
+                except OSError as e:
+                    # a restarted daemon starts counting from zero again
+                    previous = {}
+                    lines = [f'daemon disconnected ({e})', '']
+                else:
+                    t = time.monotonic()
+                    elapsed = t - last
+                    lines = []
+                    for current in samples:
+                        key = current.get('address', 'tablet')
+                        if key in previous:
+                            lines += render(previous[key], current, elapsed)
+                            lines.append('')
+                    if samples and previous:
+                        # every sample comes from the same process
+                        lines.append('cpu {:.1f}%'.format((samples[0]['cpu'] - cpu) / elapsed * 100))
+                    previous = {current.get('address', 'tablet'): current for current in samples}
+                    cpu = samples[0]['cpu'] if samples else 0.
+                    last = t
+                lines += [''] + list(tail.messages)
+
+                self.draw(screen, lines)
+                if screen.getch() in (ord('q'), ord('Q')):
+                    return
+                await asyncio.sleep(self.interval)
+        finally:
+            curses.endwin()
+            log.removeHandler(tail)
+            log.propagate = propagate
+
+    def draw(self, screen, lines):
+        screen.erase()
+        height, width = screen.getmaxyx()
+        screen.addstr(0, 0, 'remouse top (q to quit)'[:width - 1], curses.A_REVERSE)
+        for y, line in enumerate(lines[:height - 2], 2):
+            screen.addstr(y, 0, line[:width - 1])
+        screen.refresh()
@@ -0,0 +1,74 @@
+import logging
+from array import array
+
+from .frames import EV_ABS, EV_SYN, SYN_DROPPED, SYN_REPORT, code
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+_, ABS_MT_SLOT = code('ABS_MT_SLOT')
+
+# index of each multitouch axis in TouchTracker.values, the tracking id comes
+# first so a new contact is announced before its position
+mt_axes = ('TRACKING_ID', 'POSITION_X', 'POSITION_Y', 'PRESSURE',
+           'TOUCH_MAJOR', 'TOUCH_MINOR', 'ORIENTATION', 'TOOL_TYPE')
+TRACKING_ID, POSITION_X, POSITION_Y = range(3)
+mt_fields = {code('ABS_MT_' + name)[1]: i for i, name in enumerate(mt_axes)}
+
+
+class TouchTracker:
+    """Multitouch (protocol B) slot state held in fixed arrays
+
+    `values[axis][slot]` is the latest value of each axis for every slot,
+    `changed[slot]` has bit `axis` set for each axis updated since the last
+    delivered report, and `dirty` lists the changed slots so a report only
+    costs work for the contacts that moved.
+
+    Args:
+        rm (reMarkable): tablet settings, touch_slot gives the number of slots
+    """
+
+    def __init__(self, rm):
+        self.slots = rm.touch_slot.max + 1
+        self.values = [array('i', [0] * self.slots) for _ in mt_axes]
+        self.values[TRACKING_ID] = array('i', [-1] * self.slots)
+        self.changed = array('I', [0] * self.slots)
+        self.dirty = []
+        self.slot = 0
+        self.dropped = False
+
+    def feed(self, e_time, e_usec, e_type, e_code, e_value):
+        """Apply one event
+
+        Returns:
+            bool: True if the event completed a report with changes
+        """
+        if e_type == EV_ABS:
+            if e_code == ABS_MT_SLOT:
+                # events for slots we have no room for are ignored
+                self.slot = e_value if 0 <= e_value < self.slots else -1
+                return False
+            axis = mt_fields.get(e_code)
+            slot = self.slot
+            if axis is not None and slot >= 0:
+                self.values[axis][slot] = e_value
+                if not self.changed[slot]:
+                    self.dirty.append(slot)
+                self.changed[slot] |= 1 << axis
+        elif e_type == EV_SYN:
+            if e_code == SYN_REPORT:
+                # keep changes after SYN_DROPPED until the next full report
+                if self.dropped:
+                    self.dropped = False
+                    return False
+                return bool(self.dirty)
+            elif e_code == SYN_DROPPED:
+                log.debug("Touchscreen dropped events")
+                self.dropped = True
+        return False
+
+    def clear(self):
+        """Forget the changes of the report just delivered"""
+        for slot in self.dirty:
+            self.changed[slot] = 0
+        self.dirty.clear()
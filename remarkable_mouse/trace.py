@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+now = time.perf_counter
+
+
+class Tracer:
+    """Collect pipeline spans and counters for Chrome's trace event format
+
+    Events are kept in memory, newest `limit` only, and written by flush()
+    as JSON which chrome://tracing and https://ui.perfetto.dev can open.
+
+    Args:
+        path (str): file written by flush()
+        limit (int): maximum number of events kept
+    """
+
+    def __init__(self, path, limit=500000):
+        self.path = path
+        self.events = deque(maxlen=limit)
+        self.tracks = []
+
+    def track(self, name):
+        """New track (shown as a thread) for one tablet
+
+        Returns:
+            Track
+        """
+        self.tracks.append(name)
+        return Track(self.events, len(self.tracks))
+
+    def flush(self):
+        """Write all buffered events to `path`"""
+        pid = os.getpid()
+        events = [
+            {'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in enumerate(self.tracks, 1)
+        ]
+        for ph, tid, name, ts, dur, args in list(self.events):
+            event = {'ph': ph, 'name': name, 'pid': pid, 'tid': tid, 'ts': ts}
+            if ph == 'X':
+                event['dur'] = dur
+            if args:
+                event['args'] = args
+            events.append(event)
+
+        # replace the file in one step, a flush may happen while a viewer reads it
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        os.replace(tmp, self.path)
+        log.info(f"Wrote {len(events)} trace events to {self.path}")
+
+
+class Track:
+    """Record spans and counters on one track of a Tracer
+
+    Times are perf_counter() seconds, as returned by trace.now()
+    """
+
+    __slots__ = ('events', 'tid')
+
+    def __init__(self, events, tid):
+        self.events = events
+        self.tid = tid
+
+    def span(self, name, start, end, args=None):
+        self.events.append(('X', self.tid, name, start * 1e6, (end - start) * 1e6, args))
+
+    def counter(self, name, t, values):
+        self.events.append(('C', self.tid, name, t * 1e6, 0, values))
+
+
+class TeeTrack:
+    """Record spans and counters on several tracks at once"""
+
+    __slots__ = ('tracks',)
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+
+    def span(self, name, start, end, args=None):
+        for track in self.tracks:
+            track.span(name, start, end, args)
+
+    def counter(self, name, t, values):
+        for track in self.tracks:
+            track.counter(name, t, values)
+
+
+def traced(function, track, name):
+    """Wrap `function` so each call is recorded as a span"""
+    def wrapper(*args):
+        start = now()
+        result = function(*args)
+        track.span(name, start, now())
+        return result
+    return wrapper
+
+
+def trace_sink(sink, track):
+    """Trace the remap of the output backend at the end of a chain of stages"""
+    while hasattr(sink, 'sink'):
+        sink = sink.sink
+    if hasattr(sink, 'track') and hasattr(sink, 'mapping'):
+        sink.track = track
+        sink.mapping = traced(sink.mapping, track, 'remap')
@@ -0,0 +1,259 @@
+from collections import namedtuple
+import logging
+import socket
+import statistics
+import time
+
+import paramiko
+
+logging.basicConfig(format='%(message)s')
+log = logging.getLogger('remouse')
+
+# SSH transport settings
+profile = namedtuple(
+    'transport_profile',
+    ['ciphers', 'window_size', 'max_packet_size', 'compress', 'nodelay']
+)
+
+# ciphers that are cheap per packet, in order of preference.  Unsupported
+# entries are skipped, so newer paramiko versions pick up chacha20 for free
+fast_ciphers = (
+    'chacha20-poly1305@openssh.com',
+    'aes128-gcm@openssh.com',
+    'aes256-gcm@openssh.com',
+    'aes128-ctr',
+)
+
+profiles = {
+    # paramiko defaults
+    'default': profile(None, None, None, False, False),
+    # events are 16-24 bytes, so keep the channel window and packets small and
+    # send each packet as soon as it is written
+    'lowlatency': profile(fast_ciphers, 2**15, 2**12, False, True),
+    # as above, but compress for links where bandwidth is the bottleneck
+    'slowlink': profile(fast_ciphers, 2**15, 2**12, True, True),
+}
+
+
+def transport_factory(prof):
+    """Build a paramiko transport factory which applies a profile
+
+    Args:
+        prof (transport_profile): settings to apply
+
+    Returns:
+        function suitable for SSHClient.connect(transport_factory=...)
+    """
+    def factory(sock, **kwargs):
+        if prof.nodelay:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                log.debug("Could not set TCP_NODELAY on transport socket")
+        if prof.window_size is not None:
+            kwargs['default_window_size'] = prof.window_size
+        if prof.max_packet_size is not None:
+            kwargs['default_max_packet_size'] = prof.max_packet_size
+        t = paramiko.Transport(sock, **kwargs)
+        if prof.ciphers is not None:
+            options = t.get_security_options()
+            preferred = [c for c in prof.ciphers if c in options.ciphers]
+            options.ciphers = preferred + [
+                c for c in options.ciphers if c not in preferred
+            ]
+        return t
+
+    return factory
+
+
+def benchmark_transport(connect, *, e_sz=16, count=20000, pings=200):
+    """Measure throughput and latency of each transport profile
+
+    Args:
+        connect (function): takes a profile name and returns a connected
+            paramiko.SSHClient
+        e_sz (int): size of a single evdev event in bytes
+        count (int): number of events to stream for the throughput test
+        pings (int): number of round trips for the latency test
+
+    Returns:
+        dict mapping profile name to (events/s, kB/s, median ms, p95 ms)
+    """
+    results = {}
+    for name in profiles:
+        client = connect(name)
+        try:
+            # throughput: stream event-sized blocks like the pen stream does
+            stdout = client.exec_command(
+                f'dd if=/dev/zero bs={e_sz} count={count} 2>/dev/null',
+                bufsize=e_sz
+            )[1]
+            start = time.perf_counter()
+            nbytes = len(stdout.read())
+            elapsed = time.perf_counter() - start
+
+            # latency: echo single events through `cat`
+            stdin, stdout, _ = client.exec_command('cat', bufsize=0)
+            payload = bytes(e_sz)
+            rtts = []
+            for _ in range(pings):
+                start = time.perf_counter()
+                stdin.write(payload)
+                stdin.flush()
+                stdout.read(e_sz)
+                rtts.append((time.perf_counter() - start) * 1000)
+            stdin.close()
+        finally:
+            client.close()
+
+        results[name] = (
+            nbytes / e_sz / elapsed,
+            nbytes / 1000 / elapsed,
+            statistics.median(rtts),
+            statistics.quantiles(rtts, n=20)[-1],
+        )
+
+    return results
+
+
+def print_benchmark(results):
+    """Print the results of benchmark_transport as a table"""
+    print('{: <12} {: >10} {: >10} {: >10} {: >10}'.format(
+        'profile', 'events/s', 'kB/s', 'rtt p50', 'rtt p95'
+    ))
+    for name, (rate, kbps, p50, p95) in results.items():
+        print('{: <12} {: >10.0f} {: >10.1f} {: >8.2f}ms {: >8.2f}ms'.format(
+            name, rate, kbps, p50, p95
+        ))
+
+
+# first port used by the plain TCP forwarder on the tablet
+tcp_port = 33100
+# interface the tablet exposes over USB
+usb_address = '10.11.99.1'
+
+
+class ChannelStream:
+    """Read-only event stream over an SSH channel
+
+    Args:
+        stdout (paramiko.ChannelFile): output of the remote `dd`
+    """
+
+    def __init__(self, stdout):
+        self.channel = stdout.channel
+
+    def recv_into(self, b):
+        """Copy whatever data is ready into `b` without blocking
+
+        Returns:
+            int: number of bytes read, 0 on EOF
+        Raises:
+            socket.timeout: no data is ready
+        """
+        data = self.channel.recv(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def fileno(self):
+        """(int) descriptor which is readable while data is pending"""
+        return self.channel.fileno()
+
+    def pending(self):
+        """(int) bytes received but not read yet"""
+        return len(self.channel.in_buffer)
+
+    def close(self):
+        self.channel.close()
+
+
+class TCPStream:
+    """Read-only event stream over a plain TCP socket
+
+    Behaves like ChannelStream: recv_into raises socket.timeout when no data
+    is ready and returns 0 on EOF.
+
+    Args:
+        sock (socket.socket): connected socket
+        channel (paramiko.Channel, optional): SSH channel running the remote
+            forwarder, closed along with the stream
+        timeout (float): seconds to block in each read
+    """
+
+    def __init__(self, sock, channel=None, timeout=0.1):
+        sock.settimeout(timeout)
+        self.sock = sock
+        self.channel = channel
+
+    def recv_into(self, b):
+        """Receive whatever data is ready into `b`
+
+        Returns:
+            int: number of bytes read, 0 on EOF
+        Raises:
+            socket.timeout: no data is ready
+        """
+        return self.sock.recv_into(b)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+        if self.channel is not None:
+            self.channel.close()
+
+
+def open_tcp_stream(client, cmd, port, *, retries=10, allow_remote=False):
+    """Start `cmd` on the tablet with its output served on a TCP port
+
+    SSH is only used to launch the forwarder, events then travel over an
+    unencrypted socket.  The forwarder listens only on the address the
+    SSH connection reached, and by default only on the USB link.
+
+    Args:
+        client (paramiko.SSHClient): connection used to start the forwarder
+        cmd (str): command producing the event stream
+        port (int): port for the forwarder to listen on
+        retries (int): connection attempts while the forwarder starts up
+        allow_remote (bool): also stream from addresses other than the USB
+            link
+
+    Returns:
+        TCPStream
+
+    Raises:
+        ConnectionError: the address isn't allowed or the forwarder didn't
+            start
+        OSError: connecting to the forwarder failed
+    """
+    address = client.get_transport().getpeername()[0]
+    if address != usb_address:
+        if not allow_remote:
+            raise ConnectionError(f"Not streaming unencrypted events from {address}, only over USB")
+        log.warning(f"Streaming unencrypted events from {address}")
+
+    channel = client.get_transport().open_session()
+    sock = None
+    try:
+        channel.exec_command(f'{cmd} 2>/dev/null | nc -l -s {address} -p {port}')
+        for _ in range(retries):
+            try:
+                sock = socket.create_connection((address, port), timeout=1)
+                break
+            except ConnectionRefusedError:
+                if channel.exit_status_ready():
+                    break
+                time.sleep(0.1)
+        if sock is None:
+            raise ConnectionError(f"TCP forwarder on port {port} did not start")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except BaseException:
+        # don't leave the forwarder running when falling back to SSH
+        if sock is not None:
+            sock.close()
+        channel.close()
+        raise
+
+    log.debug(f"Streaming '{cmd}' over TCP port {port}")
+    return TCPStream(sock, channel)